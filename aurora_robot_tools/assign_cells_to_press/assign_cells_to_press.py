@@ -28,11 +28,14 @@ Usage:
     1, rack 2 to press 2, etc.) and limit the number of different electrolytes in each batch to 2.
 """
 
-import sqlite3
 import sys
+from pathlib import Path
 import numpy as np
 import pandas as pd
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect, read_table, update_table
+
 DATABASE_FILEPATH = "C:\\Modules\\Database\\chemspeedDB.db"
 
 if len(sys.argv) >= 2:
@@ -53,21 +56,35 @@ PRESS_TO_RACK = {
     6 : 6,
 }
 
-with sqlite3.connect(DATABASE_FILEPATH) as conn:
+with connect(DATABASE_FILEPATH) as conn:
     # Read the table Cell_Assembly_Table and Press_Table from the database
-    df = pd.read_sql("SELECT * FROM Cell_Assembly_Table", conn)
-    df_press = pd.read_sql("SELECT * FROM Press_Table", conn)
+    df = read_table(
+        conn,
+        "Cell_Assembly_Table",
+        [
+            "Rack Position",
+            "Cell Number",
+            "Last Completed Step",
+            "Error Code",
+            "Current Press Number",
+            "Electrolyte Position",
+        ],
+    )
+    df_press = read_table(conn, "Press_Table")
+    df_original = df.copy()
+    df_press_original = df_press.copy()
 
     # Check where the cell number loaded is 0 and where the error code is 0 for the presses
-    working_press_numbers = np.where((df_press["Error Code"] == 0))[0]+1
+    # The integer columns are nullable, comparisons with a missing value give NA which counts as False
+    working_press_numbers = np.where((df_press["Error Code"] == 0).fillna(False))[0]+1
 
     # Find rack positions with cells that are assigned for assembly (Cell Number > 0), have not
     # finished assembly, with no error code, and find their cell numbers and electrolyte positions
     available_rack_pos = np.where(
-        (df["Cell Number"]>0) &
+        ((df["Cell Number"]>0) &
         (df["Last Completed Step"]<11) &
         (df["Error Code"]==0) &
-        (df["Current Press Number"]==0)
+        (df["Current Press Number"]==0)).fillna(False)
         )[0]+1
     available_cell_numbers = df.loc[available_rack_pos-1, "Cell Number"].values.astype(int)
     available_electrolytes = df.loc[available_rack_pos-1, "Electrolyte Position"].values.astype(int)
@@ -78,10 +95,12 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
         print(f'Limiting electrolytes to {limit_electrolytes_per_batch} per batch')
 
     electrolytes_used = []
-    presses_with_errors = df_press.loc[df_press["Error Code"]!=0, "Press Number"].values
-    presses_already_loaded = df.loc[df["Current Press Number"]>0, "Current Press Number"].values
-    cells_already_loaded = df.loc[df["Current Press Number"]>0, "Cell Number"].values
-    rack_already_loaded = df.loc[df["Current Press Number"]>0, "Rack Position"].values
+    # A press with a missing error code is treated as having an error
+    presses_with_errors = df_press.loc[(df_press["Error Code"]!=0).fillna(True), "Press Number"].values
+    loaded_mask = (df["Current Press Number"]>0).fillna(False)
+    presses_already_loaded = df.loc[loaded_mask, "Current Press Number"].values
+    cells_already_loaded = df.loc[loaded_mask, "Cell Number"].values
+    rack_already_loaded = df.loc[loaded_mask, "Rack Position"].values
     presses_to_load = []
     cells_to_load = []
     rack_to_load = []
@@ -109,12 +128,12 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
 
         # If press already has a cell loaded
         if press in presses_already_loaded:
-            idxs = df.loc[df["Current Press Number"] == press].index
+            idxs = df.loc[(df["Current Press Number"] == press).fillna(False)].index
             error_msg = (f'Press {press} has a cell already loaded.\n'
                       'Check "Current Press Number" column in cell_assembly_table in the database.')
             assert len(idxs) == 1, error_msg
             # If there is no error, add the electrolyte to the list of used electrolytes
-            if df["Error Code"].loc[idxs[0]] == 0:
+            if (df["Error Code"] == 0).fillna(False).loc[idxs[0]]:
                 electrolyte = df["Electrolyte Position"].loc[idxs[0]]
                 electrolytes_used.append(electrolyte)
             continue
@@ -138,7 +157,7 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
             if limit_electrolytes_per_batch:
                 electrolytes_used.append(loaded_cell)
             df_press.loc[press-1, "Current Cell Number Loaded"] = loaded_cell
-            df.loc[df["Cell Number"]==loaded_cell, "Current Press Number"] = press
+            df.loc[(df["Cell Number"]==loaded_cell).fillna(False), "Current Press Number"] = press
 
             # Remove the loaded cell from the available cells
             removed_idx = np.where(available_cell_numbers==loaded_cell)[0][0]
@@ -174,8 +193,8 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
         print("Loading:\n"+
               "Press | Rack | Cell\n"+
               ''.join([f"{p:<7} {r:<6} {c:<6}\n" for p, r, c in zip(presses_to_load, rack_to_load, cells_to_load)]))
-        df_press.to_sql("Press_Table", conn, index=False, if_exists="replace")
-        df.to_sql("Cell_Assembly_Table", conn, index=False, if_exists="replace")
+        update_table(conn, "Press_Table", df_press, df_press_original, key="Press Number")
+        update_table(conn, "Cell_Assembly_Table", df, df_original, key="Rack Position")
         print('Successfully updated the database')
     elif len(cells_to_load) == 0:
         print('No cells available to load')
@@ -4,10 +4,15 @@ Script to backup the chemspeedDB database to a folder with the base sample ID as
 
 """
 
+import contextlib
 import os
-import shutil
 import sqlite3
+import sys
 from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect
 
 DATABASE_FILEPATH = "C:\\Modules\\Database\\chemspeedDB.db"
 BACKUP_FOLDER = "C:\\Modules\\Database\\Backup"
@@ -26,8 +31,13 @@ if value == "":
     value = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     print("Base Sample ID not found in the database. Using current timestamp instead.")
 
-# copy database file to backup folder with the base sample ID as the filename
+# copy database to backup folder with the base sample ID as the filename
+# the backup API also copies changes that are still in the write-ahead log in WAL mode
 os.makedirs(BACKUP_FOLDER, exist_ok=True)
 backup_filepath = f"{BACKUP_FOLDER}\\{value}.db"
-shutil.copy(DATABASE_FILEPATH, backup_filepath)
+with (
+    contextlib.closing(connect(DATABASE_FILEPATH)) as conn,
+    contextlib.closing(sqlite3.connect(backup_filepath)) as backup_conn,
+):
+    conn.backup(backup_conn)
 print(f"Database backed up to {backup_filepath}.")
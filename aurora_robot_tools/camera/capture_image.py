@@ -5,12 +5,16 @@ Simple script to capture an image from the camera and save as png and raw 12-bit
 """
 
 import os
+import sys
+from pathlib import Path
 from PIL import Image
 import numpy as np
 import gxipy as gx
 from time import sleep
 import h5py
-import sqlite3
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect, read_setting, read_table
 
 IMAGE_FOLDER = "C:/Aurora_images/"
 DATABASE_FILEPATH = "C:/Modules/Database/chemspeedDB.db"
@@ -75,17 +79,15 @@ numpy_image_8bit = (numpy_image >> 4).astype(np.uint8)
 im = Image.fromarray(numpy_image_8bit)
 
 # Get Run ID from database and cell/press numbers from database
-with sqlite3.connect(DATABASE_FILEPATH) as conn:
-    cursor = conn.cursor()
-    cursor.execute("SELECT `value` FROM Settings_Table WHERE `key` = 'Base Sample ID'")
-    run_id = cursor.fetchone()[0]
-    cursor.execute(
-        "SELECT `Current Press Number`, `Cell Number`, `Last Completed Step` "
-        "FROM Cell_Assembly_Table "
-        "WHERE `Current Press Number` > 0 AND `Error Code` = 0 "
-        "ORDER BY `Current Press Number` ASC"
+with connect(DATABASE_FILEPATH) as conn:
+    run_id = read_setting(conn, "Base Sample ID")
+    df_press = read_table(
+        conn,
+        "Cell_Assembly_Table",
+        ["Current Press Number", "Cell Number", "Last Completed Step"],
+        where='"Current Press Number" > 0 AND "Error Code" = 0',
     )
-    press_cell_steps = cursor.fetchall()
+    press_cell_steps = df_press.sort_values("Current Press Number").itertuples(index=False)
 
 # Make filename from press/cell/step numbers
 folderpath = os.path.join(IMAGE_FOLDER, run_id)
@@ -0,0 +1,222 @@
+"""Copyright © 2024, Empa, Lina Scholz, Graham Kimbell, Enea Svaluto-Ferro, Ruben Kuhnel, Corsin Battaglia.
+
+Check the faster image processing steps of process_image.py against the slower originals.
+
+Synthetic images of the pressing tools are drawn in the transformed image with a known part
+position at each press, warped with a random perspective as if taken by the camera, and then
+transformed and split into image sections with ProcessImages.
+
+The gradient magnitude used to preprocess the anode images (step 2) is computed with two cv2.Scharr
+passes. It is compared with the original convolution with a complex kernel in scipy, on the 8 bit
+gradient image and on the circle detected from it.
+
+With warp_sections, each image section is warped directly instead of cropped from the warped whole
+image. OpenCV computes the interpolation coordinates in single precision, so a few pixels differ by 1,
+and the image sections and the circles detected in them are compared for the parts of every step.
+HoughCircles is sensitive to such small differences: on these images the center moves by more than
+CENTER_TOLERANCE_PX in a few percent of the sections, mostly by a few pixels, and rarely a different
+circle is detected or none at all. The centers are reported but not checked against the tolerance,
+which is why warp_sections is not the default.
+
+The script exits with code 1 if a difference is larger than its tolerance:
+    - GRADIENT_TOLERANCE: largest difference of an 8 bit gradient pixel
+    - WARP_TOLERANCE: largest difference of an 8 bit image section pixel
+    - CENTER_TOLERANCE_PX: largest distance between the anode centers detected from both gradients,
+    in pixels of the image sections
+
+Usage:
+    py check_process_image.py [--trials N] [--seed SEED]
+
+    - `--trials`: number of synthetic images, defaults to TRIALS.
+    - `--seed`: random seed, defaults to 0.
+"""
+
+import argparse
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+from scipy import signal
+
+import process_image as pi
+
+TRIALS = 10
+
+# Size of the raw camera image (width, height) in pixels
+RAW_SIZE = (3200, 2200)
+
+# Corners of the transformed image in the raw image, each moved by a random offset with this spread
+RAW_CORNERS = np.float32([[300, 300], [2950, 230], [3000, 1900], [330, 1950]])
+RAW_CORNER_SPREAD = 30
+
+# Intensity of the background, pressing tool and part, and the spread of the noise
+BACKGROUND_INTENSITY = 40
+PRESS_INTENSITY = 90
+PART_INTENSITY = 220
+ANODE_INTENSITY = 130
+NOISE_SPREAD = 2
+
+# Standard deviation of the blur of the camera optics in pixels of the raw image, sharp edges are not detected
+RAW_BLUR_SIGMA = 2
+
+# Spread of the part offset from the pressing tool center in mm
+PART_OFFSET_SPREAD_MM = 0.4
+
+GRADIENT_TOLERANCE = 1
+WARP_TOLERANCE = 1
+CENTER_TOLERANCE_PX = 1.0
+
+# Original anode preprocessing, horizontal gradient in the real part and vertical in the imaginary
+COMPLEX_GRADIENT_KERNEL = np.array([[-3-3j, 0-10j, +3-3j], [-10+0j, 0+0j, +10+0j], [-3+3j, 0+10j, +3+3j]])
+
+
+def complex_gradient_magnitude(image: np.array) -> np.array:
+    """Compute the gradient magnitude with the original complex convolution, normalized to 8 bit."""
+    image_convolved = np.abs(signal.convolve2d(image, COMPLEX_GRADIENT_KERNEL, boundary="symm", mode="same"))
+    image_normalized = cv2.normalize(image_convolved, None, 0, 255, cv2.NORM_MINMAX)
+    return image_normalized.astype(np.uint8)
+
+
+def make_image(obj: pi.ProcessImages, step: int, rng: np.random.Generator) -> tuple[np.array, np.array]:
+    """Draw a synthetic 8 bit camera image with the part of the step on every pressing tool.
+
+    Args:
+        obj (ProcessImages): gives the press positions, part radii and transformed image size
+        step (int): robot assembly step, the part radius is the middle of its range
+        rng (numpy.random.Generator): random generator for the perspective, offsets and noise
+
+    Returns:
+        tuple: the raw image, and the transformation matrix from the raw to the transformed image
+
+    """
+    transformed = np.full(obj.transformed_size[::-1], BACKGROUND_INTENSITY, dtype=np.float32)
+    part_radius = np.mean(obj.r_part[step]) * obj.mm_to_pixel
+    for x_mm, y_mm in obj.press_position:
+        center = np.array([x_mm + obj.offset_mm, y_mm + obj.offset_mm]) * obj.mm_to_pixel
+        cv2.circle(transformed, np.round(center).astype(int), int(obj.r[1] * obj.mm_to_pixel), PRESS_INTENSITY, -1)
+        if step > 0:
+            # draw with sub-pixel precision, as the detected centers are compared to a fraction of a pixel
+            part_center = center + rng.normal(0, PART_OFFSET_SPREAD_MM * obj.mm_to_pixel, 2)
+            intensity = ANODE_INTENSITY if step == 2 else PART_INTENSITY
+            cv2.circle(transformed, np.round(part_center * 16).astype(int), int(part_radius * 16), intensity, -1,
+                       lineType=cv2.LINE_AA, shift=4)
+    corners = RAW_CORNERS + rng.normal(0, RAW_CORNER_SPREAD, RAW_CORNERS.shape).astype(np.float32)
+    m = cv2.getPerspectiveTransform(corners, np.float32((obj.mm_coords + obj.offset_mm) * obj.mm_to_pixel))
+    raw = cv2.warpPerspective(transformed, m, RAW_SIZE, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    raw = cv2.GaussianBlur(raw, (0, 0), RAW_BLUR_SIGMA)
+    raw += rng.normal(0, NOISE_SPREAD, raw.shape).astype(np.float32)
+    return np.clip(raw, 0, 255).astype(np.uint8), m
+
+
+def detect_center(obj: pi.ProcessImages, image: np.array, step: int) -> np.array:
+    """Detect the center of the part in a preprocessed image section, NaN if none is detected."""
+    radius = tuple(int(x * obj.mm_to_pixel) for x in obj.r_part[step])
+    centers, _, _ = pi._detect_circles(image.copy(), radius, obj.hough_params[step])
+    return np.array(centers[0]) if centers else np.full(2, np.nan)
+
+
+def center_distance(a: np.array, b: np.array) -> float:
+    """Distance between two detected centers, 0 if neither is detected and inf if only one is."""
+    if np.isnan(a).all() and np.isnan(b).all():
+        return 0.0
+    return float(np.linalg.norm(a - b)) if not np.isnan(a - b).any() else np.inf
+
+
+def check_gradient(obj: pi.ProcessImages, trials: int, rng: np.random.Generator) -> list[str]:
+    """Compare the Scharr gradient magnitude of anode image sections with the complex convolution.
+
+    Returns:
+        list: a description of each difference larger than its tolerance
+
+    """
+    failures = []
+    max_difference, differing, total, max_distance, detected = 0, 0, 0, 0.0, 0
+    for trial in range(trials):
+        raw, m = make_image(obj, 2, rng)
+        for press, section in obj._transform_split(raw, m, "check.h5").items():
+            image_contrast = cv2.convertScaleAbs(section, alpha=2.5, beta=0)
+            new = pi._preprocess_anode(section)
+            old = complex_gradient_magnitude(image_contrast)
+            difference = np.abs(new.astype(int) - old.astype(int))
+            max_difference = max(max_difference, int(difference.max()))
+            differing += int((difference > 0).sum())
+            total += difference.size
+            new_center, old_center = detect_center(obj, new, 2), detect_center(obj, old, 2)
+            distance = center_distance(new_center, old_center)
+            max_distance = max(max_distance, distance)
+            detected += not np.isnan(old_center).any()
+            if difference.max() > GRADIENT_TOLERANCE:
+                failures.append(f"trial {trial} press {press}: gradient differs by {difference.max()}")
+            if distance > CENTER_TOLERANCE_PX:
+                failures.append(f"trial {trial} press {press}: anode center {new_center} instead of {old_center}")
+    print(f"Gradient magnitude: max difference {max_difference} (tolerance {GRADIENT_TOLERANCE}) "
+          f"in {differing / total:.4%} of pixels, anode detected in {detected} of {total // 400**2} "
+          f"sections, max center distance {max_distance:.3f} px (tolerance {CENTER_TOLERANCE_PX} px)")
+    return failures
+
+
+def check_warp_sections(obj: pi.ProcessImages, trials: int, rng: np.random.Generator) -> list[str]:
+    """Compare the image sections warped directly with the ones cropped from the warped whole image.
+
+    Each trial uses the parts of the next step from 1 to 10, with its preprocessing and detection. The
+    centers detected in both image sections are reported, only the pixels are checked.
+
+    Returns:
+        list: a description of each difference larger than its tolerance
+
+    """
+    failures = []
+    max_difference, differing, total, max_distance, detected, moved, single = 0, 0, 0, 0.0, 0, 0, 0
+    for trial in range(trials):
+        step = trial % 10 + 1
+        raw, m = make_image(obj, step, rng)
+        obj.warp_sections = False
+        cropped = obj._transform_split(raw, m, "check.h5")
+        obj.warp_sections = True
+        warped = obj._transform_split(raw, m, "check.h5")
+        for press, section in cropped.items():
+            difference = np.abs(warped[press].astype(int) - section.astype(int))
+            max_difference = max(max_difference, int(difference.max()))
+            differing += int((difference > 0).sum())
+            total += difference.size
+            cropped_center = detect_center(obj, pi._preprocess_image(section.copy(), step), step)
+            warped_center = detect_center(obj, pi._preprocess_image(warped[press].copy(), step), step)
+            distance = center_distance(warped_center, cropped_center)
+            detected += not np.isnan(cropped_center).any()
+            single += np.isinf(distance)
+            if np.isfinite(distance):
+                max_distance = max(max_distance, distance)
+                moved += distance > CENTER_TOLERANCE_PX
+            if difference.max() > WARP_TOLERANCE:
+                failures.append(f"trial {trial} step {step} press {press}: section differs by {difference.max()}")
+    obj.warp_sections = False
+    print(f"Warped image sections: max difference {max_difference} (tolerance {WARP_TOLERANCE}) "
+          f"in {differing / total:.4%} of pixels, part detected in {detected} of {len(cropped) * trials} "
+          f"sections, center moved by more than {CENTER_TOLERANCE_PX} px in {moved} sections "
+          f"(max {max_distance:.3f} px), part detected in only one image section in {single} sections")
+    return failures
+
+
+def main() -> None:
+    """Run the checks and exit with code 1 if any difference is larger than its tolerance."""
+    parser = argparse.ArgumentParser(description="Check the faster image processing against the originals.")
+    parser.add_argument("--trials", type=int, default=TRIALS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        obj = pi.ProcessImages(tmpdir)
+        obj.debug_images = "none"
+        failures = check_gradient(obj, args.trials, rng)
+        failures += check_warp_sections(obj, args.trials, rng)
+    if failures:
+        print("Differences larger than the tolerance:")
+        print("\n".join(failures))
+        sys.exit(1)
+    print("All differences are within the tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,12 @@ The script does the following steps:
     straingt rectangle. This transformation matrix assignes a conversion factor from pixel to mm,
     which enables precise distance measurements in millimeters ensuring a consistent aspect ratio.
     3. All images are then transformed accordingly and split into image sections to be able to
-    assign the alignment of each cell component later.
+    assign the alignment of each cell component later. The images are streamed one at a time
+    through steps 3 to 5, only the small image sections are kept for the stacked image.
     4. For some components like the anode, the images are preprocessed for better detection.
     Preprocessing steps whicha are applied are increased contrast and a 2D convolution with an
-    edge detection kernel.
+    edge detection kernel. The preprocessing of each step is registered in PREPROCESSING with
+    register_preprocessing.
     5. The circles of all components are detected with OpenCV HoughCircles. The offset to the
     pressing tool center is used as a reference to determine how much each component is misaligned
     from the center of the cell in x and y. The x-axis is from the left to the right, while the
@@ -46,12 +48,40 @@ Usage: The input it the filename where the images are stores. This does not have
        folder directly without any input needed. The script will then output a JSON file and a
        stacked image with all images of each cell and step.
 
+       py process_image.py [--workers N] [--warp-sections] [--debug-images LEVEL]
+
+       - `--workers N`: number of worker processes, default 1. Once the reference of each batch is
+         known, every image is transformed, split and detected independently, so with N > 1 the
+         images are processed in parallel. The output is the same as with one worker.
+       - `--warp-sections`: warp the six 400x400 px sub-images directly instead of the whole
+         2300x1400 px image, which is about three times faster and does not save the transformed
+         images. Because of the interpolation rounding in OpenCV, less than 0.1% of the pixels
+         differ by 1 from the sub-images cropped from the whole transformed image. On synthetic
+         images, check_process_image.py finds that this moves the detected center by more than
+         1 px in a few percent of the sub-images and rarely gives another circle, so it is off by
+         default.
+       - `--debug-images LEVEL`: which images to save in the reference, transformed and
+         detected_circles folders to check the detection. "none", "failures" for references with
+         missing pressing tools and sections without a detected circle, "sampled" for the failures
+         and every 10th other image, or "all" (default). The images are saved by a background
+         thread, so saving overlaps with the detection. If it falls behind by debug_queue_size
+         images, the detection waits at most debug_queue_timeout seconds per image. After that,
+         the image is dropped and the number of dropped images is printed, except for failure
+         images, which are always saved.
+
 """
 
+import argparse
+import contextlib
 import json
 import os
+import queue
 import re
-import sqlite3
+import sys
+import threading
+import zlib
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -59,7 +89,9 @@ import h5py
 import numpy as np
 import pandas as pd
 from PIL import Image
-from scipy import signal
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect, read_setting
 
 
 def _parse_filename(filename: str) -> list[dict]:
@@ -159,17 +191,51 @@ def _detect_circles(img: np.array, radius: tuple, params: tuple) -> tuple[list[l
         r_circles = None
     return coords_circles, r_circles, img
 
-def _convolution(image: np.array, kernel: np.array) -> np.array:
-    """Take image an convolutes it with the given filter."""
-    image_convolved = signal.convolve2d(image, kernel, boundary="symm", mode="same")
-    # Compute the magnitude for the case of complex kernels
-    image_convolved = np.abs(image_convolved)
+# Preprocessing of the image sections for each step, image sections of other steps are not preprocessed
+PREPROCESSING: dict[int, Callable[[np.array], np.array]] = {}
+
+def register_preprocessing(*steps: int) -> Callable:
+    """Register a function as the preprocessing recipe of the image sections of the given steps.
+
+    The function takes an 8 bit image array and returns the image array used for detection, e.g.
+
+    @register_preprocessing(3, 4)
+    def _preprocess_separator(image: np.array) -> np.array:
+        return cv2.GaussianBlur(image, (5, 5), 1)
+
+    """
+    def decorator(function: Callable[[np.array], np.array]) -> Callable[[np.array], np.array]:
+        for step in steps:
+            PREPROCESSING[step] = function
+        return function
+    return decorator
+
+def _gradient_magnitude(image: np.array) -> np.array:
+    """Take image and compute the magnitude of its gradient, normalized to 8 bit.
+
+    This is the absolute value of the convolution with the complex kernel
+    [[-3-3j, 0-10j, +3-3j], [-10+0j, 0+0j, +10+0j], [-3+3j, 0+10j, +3+3j]], whose horizontal operator
+    is real and vertical operator is imaginary. It is computed as two real Scharr passes on float32
+    with reflected borders, which is much faster. Compared with the complex convolution in float64,
+    a few pixels differ by 1 after the conversion to 8 bit, which is checked with
+    check_process_image.py.
+    """
+    gradient_x = cv2.Scharr(image, cv2.CV_32F, 1, 0, borderType=cv2.BORDER_REFLECT)
+    gradient_y = cv2.Scharr(image, cv2.CV_32F, 0, 1, borderType=cv2.BORDER_REFLECT)
+    magnitude = cv2.magnitude(gradient_x, gradient_y)
     # Normalize the magnitude to the range [0, 255] and convert to uint8
-    image_normalized = cv2.normalize(image_convolved, None, 0, 255, cv2.NORM_MINMAX)
+    image_normalized = cv2.normalize(magnitude, None, 0, 255, cv2.NORM_MINMAX)
     return image_normalized.astype(np.uint8)
 
+@register_preprocessing(2)
+def _preprocess_anode(image: np.array) -> np.array:
+    """Take image of the anode, increase contrast and detect edges from the gradient magnitude."""
+    image_contrast = cv2.convertScaleAbs(image, alpha=2.5, beta=0) # contrast
+    # a complex kernel of the horizontal and vertical gradients gave the best results
+    return _gradient_magnitude(image_contrast)
+
 def _preprocess_image(image: np.array, step: int) -> np.array:
-    """Take image and apply preprocessing steps (blur, contrast).
+    """Take image and apply the preprocessing registered for the step (blur, contrast).
 
     Args:
         image (array): image array
@@ -179,16 +245,68 @@ def _preprocess_image(image: np.array, step: int) -> np.array:
         processed_image (array): processed image
 
     """
-    if step == 2:
-        image_contrast = cv2.convertScaleAbs(image, alpha=2.5, beta=0) # contrast
-        # a kernel with imaginary numbers gave the best results
-        # Horizontal operator is real, vertical is imaginary (for the gradients in the image)
-        filter_2 = np.array([[-3-3j, 0-10j, +3-3j], [-10+0j, 0+0j, +10+0j], [-3+3j, 0+10j, +3+3j]])
-        processed_image = _convolution(image_contrast, filter_2)
-    else:
-        processed_image = image # no preprossessing
-    return processed_image
+    if step in PREPROCESSING:
+        return PREPROCESSING[step](image)
+    return image # no preprossessing
+
 
+class _ImageWriter:
+    """Save images in a background thread, so encoding and writing them overlaps with detection.
+
+    The queue is bounded to limit the memory of waiting images. When it is full, the caller waits at
+    most put_timeout seconds for a free place, so saving never holds up the detection for longer.
+    If there is still no place, a debug image is dropped and counted, but a failure image (keep=True)
+    is saved directly by the caller. An image that cannot be saved is reported and the thread
+    continues with the next one.
+    """
+
+    def __init__(self, max_queued: int, put_timeout: float = 1, timeout: float = 60) -> None:
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.put_timeout = put_timeout # seconds to wait for a place in the queue
+        self.timeout = timeout # seconds to wait for the remaining images on close
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while (item := self.queue.get()) is not None:
+            try:
+                _write_image(*item)
+            except Exception as e:
+                self.failed += 1
+                print(f"WARNING: could not save {item[0]}: {e}")
+
+    def write(self, filepath: str, image: np.array, keep: bool = False) -> None:
+        """Queue an image to be saved, the image must not be changed afterwards.
+
+        If the queue stays full, the image is dropped, or saved directly if keep is True.
+        """
+        try:
+            self.queue.put((filepath, image), timeout=self.put_timeout)
+        except queue.Full:
+            if keep:
+                _write_image(filepath, image)
+            else:
+                self.dropped += 1
+
+    def close(self) -> None:
+        """Save the remaining images and stop the thread, waiting at most timeout seconds."""
+        with contextlib.suppress(queue.Full):
+            self.queue.put(None, timeout=self.timeout)
+        self.thread.join(self.timeout)
+        if self.thread.is_alive():
+            print(f"WARNING: debug images were still being saved after {self.timeout} seconds.")
+        if self.dropped:
+            print(f"WARNING: {self.dropped} debug images were not saved, the image writer fell behind.")
+        if self.failed:
+            print(f"WARNING: {self.failed} debug images could not be saved.")
+
+def _write_image(filepath: str, image: np.array) -> None:
+    """Save an image, creating its folder if it does not exist."""
+    # workers can create the folder at the same time
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    cv2.imwrite(filepath, image)
 
 
 class ProcessImages:
@@ -196,7 +314,6 @@ class ProcessImages:
         self.path = path # path to images
         self.run_ID = Path(self.path).name  # get run_ID from path
         self.ref = [] # list with references (coords and corresponding cell numbers)
-        self.data_list = [] # list to store image data
         self.df = pd.DataFrame(columns=["cell", "step", "press", "array"]) # dataframe for all data
 
         # Coordinates of pressing tools in mm
@@ -208,6 +325,19 @@ class ProcessImages:
         # Sub-image settings
         self.mm_to_pixel = 10 # px/mm
         self.offset_mm = 20 # mm
+        self.transformed_size = ((190 + 2*self.offset_mm)*self.mm_to_pixel,
+                                 (100 + 2*self.offset_mm)*self.mm_to_pixel) # (width, height) px
+        # Warp only the sub-images instead of the whole image, no transformed images are saved
+        self.warp_sections = False
+
+        # Debug images saved in reference, transformed and detected_circles:
+        # "none", "failures" (missing pressing tools or circles), "sampled" (failures and every
+        # debug_sample_every-th image) or "all"
+        self.debug_images = "all"
+        self.debug_sample_every = 10
+        self.debug_queue_size = 32 # images waiting to be saved, about 3 MB each
+        self.debug_queue_timeout = 1 # s to wait when the queue is full before dropping a debug image
+        self._writer = None # background image writer, only set while processing
 
         # Radii of all parts of cell in mm (key corresponds to step)
         self.r_part = {0: (9.75, 10.25), 1: (9.75, 10.25), 2: (7.25, 7.75), 3: (7, 8), 4: (7.75, 8.25),
@@ -255,11 +385,8 @@ class ProcessImages:
             coordinates, _, image_with_circles = _detect_circles(img, r_circle)
 
         # Draw all detected ellipses and save image to check quality of detection
-        # if folder doesn't exist, create it
-        if not os.path.exists(self.path + "/reference"):
-            os.makedirs(self.path + "/reference")
-        # Save the image with detected ellipses
-        cv2.imwrite(self.path + f"/reference/{ref_image_name}.jpg", image_with_circles)
+        failed = len(coordinates) != len(self.press_position)
+        self._save_debug_image(f"reference/{ref_image_name}.jpg", image_with_circles, failed)
 
         transformation_M = self._get_transformation_matrix(coordinates) # determine trasnformation matrix
         return (transformation_M, [d["c"] for d in filenameinfo]) # transformation matrix with cell numbers
@@ -290,9 +417,35 @@ class ProcessImages:
         # Return the transformation matrix
         return cv2.getPerspectiveTransform(centers_sorted, pts2)
 
+    def _section_bounds(self, shape: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+        """Get the top, bottom, left and right pixel of each press position in the transformed image.
+
+        Args:
+            shape (tuple): height and width of the image before transformation
+
+        Returns:
+            list of tuples (top, bottom, left, right), sorted by press position
+
+        """
+        bounds = []
+        height, width = shape
+        transformed_width, transformed_height = self.transformed_size
+        for c in self.press_position:
+            # set zero in case it gives a negative number
+            # set to maximum width, height in case of too large number
+            bottom_right_y = min((c[1] + 2*self.offset_mm) * self.mm_to_pixel, height, transformed_height)
+            bottom_right_x = min((c[0] + 2*self.offset_mm) * self.mm_to_pixel, width, transformed_width)
+            top_left_y = max(bottom_right_y - 2*self.offset_mm*self.mm_to_pixel, 0)
+            top_left_x = max(bottom_right_x - 2*self.offset_mm*self.mm_to_pixel, 0)
+            bounds.append((top_left_y, bottom_right_y, top_left_x, bottom_right_x))
+        return bounds
+
     def _transform_split(self, img: np.array, m: np.array, filename: str) -> dict[np.array]:
         """Transform and crop an image to give one sub-image per press position.
 
+        If warp_sections is set, each sub-image is warped directly with the translation of its
+        crop composed into the transformation matrix, and no transformed image is saved.
+
         Args:
             img (array): image array
             m (array): transformation matrix
@@ -302,61 +455,105 @@ class ProcessImages:
             cropped_images (array): transformed image splitted into subsections
 
         """
-        transformed_image = cv2.warpPerspective(img, m,
-                                                ((190+ 2* self.offset_mm)*self.mm_to_pixel,
-                                                 (100+ 2* self.offset_mm)*self.mm_to_pixel))
-        # if folder doesn't exist, create it
-        if not os.path.exists(self.path + "/transformed"):
-            os.makedirs(self.path + "/transformed")
-        # Save the image with detected ellipses
-        cv2.imwrite(self.path + f"/transformed/{filename.split(".")[0]}.jpg", transformed_image)
+        if self.warp_sections:
+            cropped_images = {}
+            for i, (top, bottom, left, right) in enumerate(self._section_bounds(img.shape)):
+                # move the top left corner of the sub-image to the origin
+                translation = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float64)
+                cropped_images[i+1] = cv2.warpPerspective(img, translation @ m, (right - left, bottom - top))
+            return cropped_images
+
+        transformed_image = cv2.warpPerspective(img, m, self.transformed_size)
+        # Save the transformed image
+        self._save_debug_image(f"transformed/{filename.split(".")[0]}.jpg", transformed_image)
         # Crop the image
         cropped_images = {}
-        for i, c in enumerate(self.press_position):
-            # set zero in case it gives a negative number
-            # set to maximum width, height in case of too large number
-            height, width = img.shape
-            bottom_right_y = min((c[1] + 2*self.offset_mm) * self.mm_to_pixel, height)
-            bottom_right_x = min((c[0] + 2*self.offset_mm) * self.mm_to_pixel, width)
-            top_left_y = max(bottom_right_y - 2*self.offset_mm*self.mm_to_pixel, 0)
-            top_left_x = max(bottom_right_x - 2*self.offset_mm*self.mm_to_pixel, 0)
-            cropped_image = transformed_image[top_left_y:bottom_right_y, top_left_x:bottom_right_x]
-            cropped_images[i+1] = cropped_image
+        for i, (top, bottom, left, right) in enumerate(self._section_bounds(img.shape)):
+            # copy, so a kept image section does not keep the whole transformed image in memory
+            cropped_images[i+1] = transformed_image[top:bottom, left:right].copy()
         return cropped_images
 
-    def load_files(self) -> list[tuple]:
-        """Load images and stores them in list with filename and image array.
+    def _save_debug_image(self, filename: str, image: np.array, failed: bool = False) -> None:
+        """Save a debug image in the image folder if selected by debug_images.
 
-        All images are loaded and stored in list with a tuple of their filename and 8 bit image
-        array. Images from step 0 are stored additionally in a separate list to use them as a
-        reference for the coordinate transformation.
+        The image is saved in the background while processing, so it must not be changed afterwards.
 
-        Returns:
-            list: list containing filename, information from image name and image array
+        Args:
+            filename (str): path of the image relative to the image folder
+            image (array): image array
+            failed (bool): True if the detection on this image failed
 
         """
-        for filename in os.listdir(self.path):
-            if filename.endswith(".h5"): # read all .h5 files
-                filepath = os.path.join(self.path, filename)
-                with h5py.File(filepath, "r") as f:
-                    content = f["image"][:]
-                    content = content/np.max(content)*255 # convert to 8 bit
-                    content = content.astype(np.uint8) # image array
-                info = _parse_filename(filename) # extract info from filename
-                if all(d["s"] == 0 for d in info): # if step 0, get reference coordinates
-                    matrix = self._get_references(info, content) # transformation matrix with cell numbers
-                    self.ref.append(matrix)
-                self.data_list.append((filename, info, content)) # store info and image array
-        return self.data_list
-
-    def store_data(self, data_list: list[tuple]) -> pd.DataFrame:
-        """For each image array transform image and store image sections in DataFrame.
+        if self.debug_images == "none" or (self.debug_images == "failures" and not failed):
+            return
+        # sample by filename, so the same images are saved with any number of workers
+        if self.debug_images == "sampled" and not failed and zlib.crc32(filename.encode()) % self.debug_sample_every:
+            return
+        filepath = os.path.join(self.path, filename)
+        if self._writer is not None:
+            self._writer.write(filepath, image, keep=failed)
+        else:
+            _write_image(filepath, image)
+
+    @contextlib.contextmanager
+    def _background_writer(self) -> Iterator[None]:
+        """Save the debug images in a background thread while the with block runs."""
+        self._writer = _ImageWriter(self.debug_queue_size, self.debug_queue_timeout)
+        try:
+            yield
+        finally:
+            self._writer.close()
+            self._writer = None
+
+    def _h5_files(self) -> list[tuple[str, list[dict]]]:
+        """Get the filename and the information from the filename of every .h5 image in the folder."""
+        return [(filename, _parse_filename(filename)) for filename in os.listdir(self.path)
+                if filename.endswith(".h5")]
+
+    def _read_image(self, filename: str) -> np.array:
+        """Read an .h5 image and convert it to an 8 bit image array."""
+        with h5py.File(os.path.join(self.path, filename), "r") as f:
+            content = f["image"][:]
+        content = content/np.max(content)*255 # convert to 8 bit
+        return content.astype(np.uint8) # image array
+
+    def load_references(self) -> list[tuple]:
+        """Get the transformation matrix of each batch from its step 0 image of the pressing tools.
+
+        Only the step 0 images are read here, so all references are known before the other images
+        are streamed through the pipeline.
 
         Returns:
-            self.df (DataFrame): columns cell, step, press, transformed image section, center coordinates
+            list: list of tuples with transformation matrix and cell numbers
+
+        """
+        for filename, info in self._h5_files():
+            if all(d["s"] == 0 for d in info): # if step 0, get reference coordinates
+                matrix = self._get_references(info, self._read_image(filename))
+                self.ref.append(matrix) # transformation matrix with cell numbers
+        return self.ref
+
+    def load_files(self) -> Iterator[tuple[str, list[dict], np.array]]:
+        """Load the images one at a time.
+
+        Yields:
+            tuple: filename, information from image name and 8 bit image array
+
+        """
+        for filename, info in self._h5_files():
+            yield filename, info, self._read_image(filename)
+
+    def split_images(self, images: Iterable[tuple]) -> Iterator[dict]:
+        """Transform each image with the matrix of its batch and split it into image sections.
+
+        Args:
+            images (iterable): filename, information from image name and image array
+
+        Yields:
+            dict: cell, step, press and transformed image section
 
         """
-        for name, information, image in data_list:
+        for name, information, image in images:
             try:
                 transformation_matrix = next(m for m, cells in self.ref if cells == [d["c"] for d in information])
             except StopIteration:
@@ -364,20 +561,66 @@ class ProcessImages:
                 transformation_matrix = self.ref[0][0]
             image_sections = self._transform_split(image, transformation_matrix, name) # transform and split image
             for dictionary in information:
-                # add information to data frame
-                row = [dictionary["c"], dictionary["s"], dictionary["p"], image_sections[int(dictionary["p"])]]
-                self.df.loc[len(self.df)] = row
+                yield {
+                    "cell": dictionary["c"],
+                    "step": dictionary["s"],
+                    "press": dictionary["p"],
+                    "array": image_sections[int(dictionary["p"])],
+                }
+
+    def detect_centers(self, sections: Iterable[dict]) -> Iterator[dict]:
+        """Detect the center of the part in each image section.
+
+        Args:
+            sections (iterable): dicts with cell, step, press and image section
+
+        Yields:
+            dict: the image section with center coordinates x, y in pixel and radius r_mm added
+
+        """
+        for section in sections:
+            # get radius range of component
+            r = tuple(int(x * self.mm_to_pixel) for x in self.r_part[section["step"]])
+            # circles are drawn on the image, keep the image section clean for the stacked image
+            img = _preprocess_image(section["array"].copy(), section["step"]) # preprocess image
+            parameter = self.hough_params[section["step"]] # parameter for HoughCircles
+            if section["step"] == "type in step of part which should be detected as ellipse":
+                center, rad, image_with_circles = _detect_ellipses(img, r, parameter)
+            else: # detect circle
+                center, rad, image_with_circles = _detect_circles(img, r, parameter)
+            # Assuming center as a list containing a tuple
+            if center is not None and isinstance(center, list) and len(center) > 0:
+                section["x"] = center[0][0]
+                section["y"] = center[0][1]
+                section["r_mm"] = rad[0]/self.mm_to_pixel
+            else:
+                # Handle the case where center is None or not as expected
+                section["x"] = np.nan
+                section["y"] = np.nan
+                section["r_mm"] = None
+            # for cross check save image with detected circles
+            filename = f"c{section["cell"]}_p{section["press"]}_s{section["step"]}"
+            failed = np.isnan(section["x"])
+            self._save_debug_image(f"detected_circles/{filename}.jpg", image_with_circles, failed)
+            yield section
+
+    def store_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Store all image sections in one big stacked image and add their row and column in it.
+
+        Returns:
+            self.df (DataFrame): data frame sorted by cell and step, with img_row and img_col added
 
+        """
         # save images in one big stacked image
-        self.height, self.width = self.df["array"][0].shape[:2]
-        self.df = self.df.sort_values(by=["cell", "step"]) # Ensure images are sorted by 'cell' and 'step'
+        self.height, self.width = df["array"][0].shape[:2]
+        df = df.sort_values(by=["cell", "step"]) # Ensure images are sorted by 'cell' and 'step'
         # Create a 10x36 grid composite image
         image_rows = []
         cols = []
         rows = []
-        max_images_per_row = max(self.df.groupby("cell")["step"].count())
-        for i, cell in enumerate(self.df["cell"].unique()):
-            cell_images = self.df[self.df["cell"] == cell].sort_values(by="step")["array"].to_list()
+        max_images_per_row = max(df.groupby("cell")["step"].count())
+        for i, cell in enumerate(df["cell"].unique()):
+            cell_images = df[df["cell"] == cell].sort_values(by="step")["array"].to_list()
             num_images = len(cell_images)
             # Normalize the images and convert them to 8-bit
             cell_images = [img / np.max(img) * 255 for img in cell_images]
@@ -392,8 +635,9 @@ class ProcessImages:
             cols.extend(range(num_images))
         composite_image = np.vstack(image_rows)
 
-        self.df["img_row"] = rows
-        self.df["img_col"] = cols
+        # position in the stacked image goes next to the image section
+        df.insert(df.columns.get_loc("array") + 1, "img_row", rows)
+        df.insert(df.columns.get_loc("img_row") + 1, "img_col", cols)
         # create path if not existent
         data_dir = os.path.join(self.path, "json")
         if not os.path.exists(data_dir):
@@ -406,48 +650,16 @@ class ProcessImages:
         jpg_filename = os.path.join(data_dir, f"alignment.{self.run_ID}.jpg")
         Image.fromarray(composite_image).save(jpg_filename)
 
-        return self.df
+        self.df = df
+        return df
 
-    def get_centers(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Detect centers of parts for each image section in data frame.
+    def get_alignment(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Get the offset of each part to the pressing tool center from step 0 of the same cell.
 
         Returns:
-            self.df (data frame): data frame with column of center coordinates added
+            self.df (data frame): data frame with reference coordinates and offsets added
 
         """
-        x = [] # list to store coordinates
-        y = []
-        radius = [] # list to store radius
-        for _index, row in df.iterrows():
-            # get radius range of component
-            r = tuple(int(x * self.mm_to_pixel) for x in self.r_part[row["step"]])
-            img = _preprocess_image(row["array"], row["step"]) # preprocess image
-            parameter = self.hough_params[row["step"]] # parameter for HoughCircles
-            if row["step"] == "type in step of part which should be detected as ellipse":
-                center, rad, image_with_circles = _detect_ellipses(img, r, parameter)
-            else: # detect circle
-                center, rad, image_with_circles = _detect_circles(img, r, parameter)
-            # Assuming center as a list containing a tuple
-            if center is not None and isinstance(center, list) and len(center) > 0:
-                x.append(center[0][0])
-                y.append(center[0][1])
-                radius.append(rad[0]/self.mm_to_pixel)
-            else:
-                # Handle the case where center is None or not as expected
-                x.append(np.nan)
-                y.append(np.nan)
-                radius.append(None)
-            # for cross check save image:
-            # if folder doesn't exist, create it
-            if not os.path.exists(self.path + "/detected_circles"):
-                os.makedirs(self.path + "/detected_circles")
-            # Save the image with detected circles
-            filename = f"c{row["cell"]}_p{row["press"]}_s{row["step"]}"
-            cv2.imwrite(self.path + f"/detected_circles/{filename}.jpg", image_with_circles)
-        # store raw coordinates in pixel
-        df["x"] = x
-        df["y"] = y
-        df["r_mm"] = radius
         # get difference to pressing tool in pixel
         df = df.sort_values(by=["cell", "step"]) # Ensure images are sorted by 'cell' and 'step'
 
@@ -467,6 +679,44 @@ class ProcessImages:
         self.df = df
         return df
 
+    def _process_file(self, filename: str, info: list[dict]) -> list[dict]:
+        """Transform, split and detect one image, run in a worker process."""
+        images = [(filename, info, self._read_image(filename))]
+        with self._background_writer():
+            return list(self.detect_centers(self.split_images(images)))
+
+    def process(self, workers: int = 1) -> pd.DataFrame:
+        """Stream the images one at a time through transform, split and detection.
+
+        The references are determined first, then each image is loaded, transformed, split and its
+        sections detected before the next image is loaded. Only the image sections are kept for the
+        stacked image, so the memory does not grow with the full images of a run. With more than one
+        worker, the images are processed in parallel worker processes once the references are known.
+        The results are collected in the order of the files, so the output is the same. The debug
+        images are saved by a background thread in each process.
+
+        Args:
+            workers (int, optional): Number of worker processes, 1 processes the images in this
+                process. Defaults to 1.
+
+        Returns:
+            self.df (DataFrame): data frame with image sections, center coordinates and alignment
+
+        """
+        with self._background_writer():
+            self.load_references()
+        if workers > 1:
+            # each worker process uses one OpenCV thread, the parallelism is across images
+            with ProcessPoolExecutor(max_workers=workers, initializer=cv2.setNumThreads, initargs=(1,)) as executor:
+                futures = [executor.submit(self._process_file, filename, info) for filename, info in self._h5_files()]
+                sections = [section for future in futures for section in future.result()]
+        else:
+            with self._background_writer():
+                sections = list(self.detect_centers(self.split_images(self.load_files())))
+        df = self.store_data(pd.DataFrame(sections))
+        df = self.get_alignment(df)
+        return self.correct_for_thickness(df)
+
     def correct_for_thickness(self, df: pd.DataFrame) -> pd.DataFrame:
         """Account for thickness of parts shifting detected centres due to perspective.
 
@@ -529,21 +779,24 @@ class ProcessImages:
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Detect the alignment of the cell parts in the images of a run.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--warp-sections", action="store_true")
+    parser.add_argument("--debug-images", choices=["none", "failures", "sampled", "all"], default="all")
+    args = parser.parse_args()
+
     # Get Run ID from database
     DATABASE_FILEPATH = "C:/Modules/Database/chemspeedDB.db"
-    with sqlite3.connect(DATABASE_FILEPATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT `value` FROM Settings_Table WHERE `key` = 'Base Sample ID'")
-        run_id = cursor.fetchone()[0]
+    with connect(DATABASE_FILEPATH) as conn:
+        run_id = read_setting(conn, "Base Sample ID")
 
     # PARAMETER
     IMAGE_FOLDER = "C:/Aurora_images/"
     folderpath = os.path.join(IMAGE_FOLDER, run_id)
 
     obj = ProcessImages(folderpath)
-    data_list = obj.load_files()
-    df = obj.store_data(data_list)
-    df = obj.get_centers(df)
-    df = obj.correct_for_thickness(df)
+    obj.warp_sections = args.warp_sections
+    obj.debug_images = args.debug_images
+    df = obj.process(args.workers)
     coordinates_df = obj.save()
 
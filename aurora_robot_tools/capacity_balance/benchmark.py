@@ -0,0 +1,387 @@
+"""Copyright © 2024, Empa, Graham Kimbell, Enea Svaluto-Ferro, Ruben Kuhnel, Corsin Battaglia.
+
+Benchmark the capacity balancing sorting methods on synthetic electrode populations.
+
+Synthetic Cell_Assembly_Table batches are generated with a realistic spread of electrode weights,
+some missing electrodes, and either one, a few or all different N:P ratio targets. Every sorting
+method is run on each batch, and the wall time, peak memory, accepted cell count and mean N:P
+deviation are recorded.
+
+When exact matching (method 5) is benchmarked, it is first checked against trying every matching
+of small batches with many missing electrodes, and the script exits with code 1 if it did not find
+and prove the optimum.
+
+The results are compared with a stored baseline, and the script exits with code 1 if any method used
+more memory, or accepted fewer cells or had a worse N:P deviation than the baseline. Wall times
+depend on the computer, so they are first scaled by how much slower REFERENCE_METHOD ran than in
+the baseline, and methods that got slower than that are only reported as a warning. Peak memory is
+measured with tracemalloc in this process, so it does not depend on the computer, and does not
+include the worker processes of the portfolio method (9).
+
+Usage:
+    py benchmark.py [--sizes N ...] [--methods M ...] [--baseline FILE] [--update-baseline]
+
+    - `--sizes`: batch sizes to benchmark, defaults to BATCH_SIZES.
+    - `--methods`: sorting methods to benchmark, defaults to 1-11, see capacity_balance.py.
+        REFERENCE_METHOD is always run.
+    - `--baseline`: baseline JSON file, defaults to benchmark_baseline.json next to this script.
+    - `--update-baseline`: write the results to the baseline file instead of comparing.
+    - `--output`: also write the results to this JSON file.
+    - `--calibrate`: fit the solve time model used by automatic method selection (sorting method 6)
+        to the results, and write it to solve_time_model.json.
+
+    e.g. `py benchmark.py --sizes 6 36 --methods 3 6`
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import capacity_balance as cb
+
+BASELINE_FILEPATH = Path(__file__).parent / "benchmark_baseline.json"
+BATCH_SIZES = [6, 12, 36, 100, 300, 1000]
+SORTING_METHODS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+RATIO_CASES = ["uniform", "classes", "distinct"]
+
+# Largest batches to run with methods that build an n x n x n cost matrix, and with exact matching
+MAX_3D_BATCH_SIZE = 100
+MAX_EXACT_BATCH_SIZE = 36
+EXACT_TIMEOUT_SECONDS = 10
+
+# Sorting method whose wall time compared with the baseline gives the speed of the computer
+REFERENCE_METHOD = 3
+MIN_REFERENCE_SECONDS = 0.01
+
+# Allowed change from the baseline before it counts as a regression, or a warning for wall time
+TIME_TOLERANCE_FACTOR = 2.0
+TIME_TOLERANCE_SECONDS = 0.5
+MEMORY_TOLERANCE_FACTOR = 1.5
+ACCEPTED_TOLERANCE_FRACTION = 0.02
+DEVIATION_TOLERANCE = 0.002
+
+# Small batches with many missing electrodes and N:P ratios where exact matching (method 5) is
+# checked against trying every matching
+BRUTE_FORCE_SIZES = [1, 2, 3, 4, 5]
+BRUTE_FORCE_SEEDS = 10
+BRUTE_FORCE_MISSING_FRACTION = 0.3
+
+# Sorting methods that automatic selection chooses from, and the shortest time used in the fit
+CALIBRATION_METHODS = [3, 4, 5, 7, 8]
+MIN_CALIBRATION_SECONDS = 1e-3
+
+RATIO_CLASSES = [(1.10, 1.00, 1.20), (1.20, 1.10, 1.30), (1.15, 1.05, 1.25)]
+
+
+def make_cell_assembly_table(
+        n: int,
+        ratio_case: str = "uniform",
+        missing_fraction: float = 0.05,
+        seed: int = 0,
+    ) -> pd.DataFrame:
+    """Generate a synthetic Cell_Assembly_Table with one batch of n cells.
+
+    Electrode weights are normally distributed around typical values with a few percent spread.
+    A fraction of the anodes and cathodes are missing (NaN weight), as if they were not weighed.
+
+    Args:
+        n (int): number of cells in the batch.
+        ratio_case (str, optional): "uniform" for one N:P ratio target, "classes" for a few
+            different targets, "distinct" for a different target for every cell.
+        missing_fraction (float, optional): fraction of anodes and cathodes with no weight.
+        seed (int, optional): random seed.
+
+    Returns:
+        pandas.DataFrame: The synthetic cell assembly data.
+
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"Rack Position": np.arange(1, n + 1), "Batch Number": 1})
+    for xode, weight, collector_weight, fraction, capacity, diameter in (
+        ("Anode", 24.0, 10.0, 0.95, 350.0, 15.0),
+        ("Cathode", 30.0, 8.0, 0.90, 180.0, 14.0),
+    ):
+        weights = rng.normal(weight, 0.04 * weight, n)
+        weights[rng.random(n) < missing_fraction] = np.nan
+        df[f"{xode} Type"] = xode
+        df[f"{xode} Weight (mg)"] = weights
+        df[f"{xode} Current Collector Weight (mg)"] = collector_weight
+        df[f"{xode} Active Material Weight Fraction"] = fraction
+        df[f"{xode} Balancing Specific Capacity (mAh/g)"] = capacity
+        df[f"{xode} Diameter (mm)"] = diameter
+        df[f"{xode} Rack Position"] = df["Rack Position"]
+
+    match ratio_case:
+        case "uniform":
+            ratios = np.tile(RATIO_CLASSES[0], (n, 1))
+        case "classes":
+            ratios = np.array(RATIO_CLASSES)[rng.integers(len(RATIO_CLASSES), size=n)]
+        case "distinct":
+            targets = rng.uniform(1.05, 1.25, n)
+            ratios = np.column_stack([targets, targets - 0.1, targets + 0.1])
+        case _:
+            msg = f"Unknown ratio case: {ratio_case}"
+            raise ValueError(msg)
+    df["Target N:P Ratio"] = ratios[:, 0]
+    df["Minimum N:P Ratio"] = ratios[:, 1]
+    df["Maximum N:P Ratio"] = ratios[:, 2]
+    df["Last Completed Step"] = 0
+    df["Error Code"] = 0
+    return df
+
+
+def is_3d(sorting_method: int, ratio_case: str) -> bool:
+    """Check if a sorting method builds an n x n x n cost matrix for this ratio case."""
+    return sorting_method in (4, 5, 7, 9) or (sorting_method in (6, 8, 11) and ratio_case == "distinct")
+
+
+def run_case(sorting_method: int, n: int, ratio_case: str, seed: int = 0) -> dict:
+    """Run one sorting method on one synthetic batch and measure it.
+
+    Args:
+        sorting_method (int): The sorting method, see capacity_balance.py.
+        n (int): number of cells in the batch.
+        ratio_case (str): "uniform", "classes" or "distinct", see make_cell_assembly_table.
+        seed (int, optional): random seed for the synthetic batch.
+
+    Returns:
+        dict: The batch features, wall time, peak memory, accepted cell count and mean N:P deviation.
+
+    """
+    df = make_cell_assembly_table(n, ratio_case, seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cb.calculate_capacity(df)
+        ((_batch_number, row_indices),) = cb.get_batches(df)
+    df_batch = df.iloc[row_indices]
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        solution = cb.solve_batch(
+            df_batch, sorting_method, deadline=time.perf_counter() + EXACT_TIMEOUT_SECONDS,
+        )
+    wall_time = time.perf_counter() - start_time
+    _current, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    accepted, mean_deviation = cb.evaluate_matching(df_batch, *solution)
+    return {
+        "sorting_method": sorting_method,
+        "n": n,
+        "ratio_case": ratio_case,
+        "cells": len(row_indices),
+        "features": cb.get_batch_features(df_batch),
+        "wall_time_s": wall_time,
+        "peak_memory_mb": peak_memory / 1e6,
+        "accepted": accepted,
+        "mean_deviation": None if np.isnan(mean_deviation) else mean_deviation,
+    }
+
+
+def brute_force_cost(cost_matrix: np.ndarray) -> float:
+    """Find the lowest cost of any matching of a small n x n x n cost matrix by trying them all."""
+    n = cost_matrix.shape[0]
+    perms = np.array(list(itertools.permutations(range(n))))
+    costs = cost_matrix[np.arange(n), perms[:, np.newaxis, :], perms[np.newaxis, :, :]].sum(axis=2)
+    return float(costs.min())
+
+
+def check_exact_matching(sizes: list[int] = BRUTE_FORCE_SIZES, seeds: int = BRUTE_FORCE_SEEDS) -> list[str]:
+    """Check that exact matching finds and proves the optimum of small batches.
+
+    Exact matching only models the triples below the rejection cost, and matches up the rejected
+    electrodes after solving, so batches with many missing electrodes and N:P ratios are solved with
+    and without the greedy warm start and compared with brute force.
+
+    Args:
+        sizes (list[int], optional): batch sizes, small enough to try every matching. Defaults to
+            BRUTE_FORCE_SIZES.
+        seeds (int, optional): number of random batches of each size and ratio case. Defaults to
+            BRUTE_FORCE_SEEDS.
+
+    Returns:
+        list: A description of each batch where the matching cost or the lower bound is not the
+            optimum.
+
+    """
+    failures = []
+    for n, ratio_case, seed in itertools.product(sizes, RATIO_CASES, range(seeds)):
+        df = make_cell_assembly_table(n, ratio_case, BRUTE_FORCE_MISSING_FRACTION, seed)
+        if seed % 2:
+            df.loc[np.random.default_rng(seed).random(n) < BRUTE_FORCE_MISSING_FRACTION, "Target N:P Ratio"] = np.nan
+        with contextlib.redirect_stdout(io.StringIO()):
+            cb.calculate_capacity(df)
+            cost_matrix = cb.cost_matrix_3d(df)
+            optimum = brute_force_cost(cost_matrix)
+            for initial in (None, cb.greedy_npartite_matching(cost_matrix)):
+                *matching, lower_bound = cb.exact_npartite_matching(cost_matrix, initial=initial)
+                cost = cost_matrix[tuple(matching)].sum()
+                if abs(cost - optimum) > 1e-6 or lower_bound is None or abs(lower_bound - optimum) > 1e-6:
+                    failures.append(
+                        f"n={n} {ratio_case} seed {seed}{' warm start' if initial is not None else ''}: "
+                        f"cost {cost:.4f}, lower bound {lower_bound}, optimum {optimum:.4f}",
+                    )
+    return failures
+
+
+def run_benchmark(sizes: list[int], sorting_methods: list[int]) -> dict[str, dict]:
+    """Run every sorting method on every batch size and ratio case.
+
+    Returns:
+        dict: The results of each case, keyed by "method/ratio case/n".
+
+    """
+    results = {}
+    for n in sizes:
+        for ratio_case in RATIO_CASES:
+            for sorting_method in sorting_methods:
+                if is_3d(sorting_method, ratio_case) and n > MAX_3D_BATCH_SIZE:
+                    continue
+                if sorting_method in (5, 9) and n > MAX_EXACT_BATCH_SIZE:
+                    continue
+                result = run_case(sorting_method, n, ratio_case)
+                key = f"{sorting_method}/{ratio_case}/{n}"
+                results[key] = result
+                mean_deviation = np.nan if result["mean_deviation"] is None else result["mean_deviation"]
+                print(f"{key:<20} {result['wall_time_s']:>8.3f} s {result['peak_memory_mb']:>9.1f} MB "
+                      f"{result['accepted']:>5}/{result['cells']:<5} accepted, mean deviation {mean_deviation:.4f}")
+    return results
+
+
+def machine_slowdown(results: dict[str, dict], baseline: dict[str, dict]) -> float:
+    """Get how many times slower this computer is than the one the baseline was made on.
+
+    This is the total wall time of REFERENCE_METHOD over the cases in both the results and the
+    baseline, divided by the baseline total. It is 1 if the baseline total is too short to measure.
+    """
+    keys = [key for key, result in results.items() if result["sorting_method"] == REFERENCE_METHOD and key in baseline]
+    baseline_seconds = sum(baseline[key]["wall_time_s"] for key in keys)
+    if baseline_seconds < MIN_REFERENCE_SECONDS:
+        return 1.0
+    return sum(results[key]["wall_time_s"] for key in keys) / baseline_seconds
+
+
+def find_regressions(results: dict[str, dict], baseline: dict[str, dict]) -> tuple[list[str], list[str]]:
+    """Compare benchmark results with the baseline.
+
+    Wall times are compared after scaling the baseline by machine_slowdown, and only give warnings.
+
+    Returns:
+        tuple: A description of each regression and of each wall time warning, empty if none.
+
+    """
+    regressions = []
+    warnings = []
+    slowdown = machine_slowdown(results, baseline)
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        base_time = base["wall_time_s"] * slowdown
+        if result["wall_time_s"] > base_time * TIME_TOLERANCE_FACTOR + TIME_TOLERANCE_SECONDS:
+            warnings.append(
+                f"{key}: wall time {result['wall_time_s']:.3f} s, baseline {base_time:.3f} s "
+                f"scaled by {slowdown:.2f} for this computer",
+            )
+        if result["peak_memory_mb"] > base["peak_memory_mb"] * MEMORY_TOLERANCE_FACTOR + 1:
+            regressions.append(
+                f"{key}: peak memory {result['peak_memory_mb']:.1f} MB, baseline {base['peak_memory_mb']:.1f} MB",
+            )
+        if result["accepted"] < base["accepted"] - int(ACCEPTED_TOLERANCE_FRACTION * result["cells"]):
+            regressions.append(f"{key}: accepted {result['accepted']} cells, baseline {base['accepted']}")
+        if (
+            result["mean_deviation"] is not None and base["mean_deviation"] is not None
+            and result["mean_deviation"] > base["mean_deviation"] + DEVIATION_TOLERANCE
+        ):
+            regressions.append(
+                f"{key}: mean N:P deviation {result['mean_deviation']:.4f}, baseline {base['mean_deviation']:.4f}",
+            )
+    return regressions, warnings
+
+
+def calibrate_solve_time_model(results: dict[str, dict]) -> dict:
+    """Fit the log-linear solve time model of each sorting method to the benchmark results.
+
+    The log of the wall time is fitted by least squares to the regressors from
+    capacity_balance.solve_time_features.
+
+    Returns:
+        dict: The model coefficients of each sorting method, to be saved as JSON.
+
+    """
+    coefficients = {}
+    for sorting_method in CALIBRATION_METHODS:
+        method_results = [result for result in results.values() if result["sorting_method"] == sorting_method]
+        if len(method_results) < 4:
+            print(f"Not enough results to calibrate sorting method {sorting_method}")
+            continue
+        x = np.array([cb.solve_time_features(result["features"]) for result in method_results])
+        y = np.log(np.maximum([result["wall_time_s"] for result in method_results], MIN_CALIBRATION_SECONDS))
+        coefficients[str(sorting_method)] = np.linalg.lstsq(x, y, rcond=None)[0].tolist()
+    return {
+        "regressors": ["intercept", "log(n)", "log(ratio_classes)", "infeasible_fraction"],
+        "coefficients": coefficients,
+    }
+
+
+def main() -> None:
+    """Run the benchmark and compare with, or update, the baseline."""
+    parser = argparse.ArgumentParser(description="Benchmark the capacity balancing sorting methods.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--methods", type=int, nargs="+", default=SORTING_METHODS)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILEPATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--calibrate", action="store_true")
+    args = parser.parse_args()
+
+    if 5 in args.methods:
+        failures = check_exact_matching()
+        if failures:
+            print("Exact matching did not find or prove the optimum:")
+            print("\n".join(failures))
+            sys.exit(1)
+        print("Exact matching found and proved the optimum of every small batch")
+
+    methods = args.methods if REFERENCE_METHOD in args.methods else [REFERENCE_METHOD, *args.methods]
+    results = run_benchmark(args.sizes, methods)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.calibrate:
+        model = calibrate_solve_time_model(results)
+        cb.SOLVE_TIME_MODEL_FILEPATH.write_text(json.dumps(model, indent=2))
+        print(f"Wrote solve time model to {cb.SOLVE_TIME_MODEL_FILEPATH}")
+
+    if args.update_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2))
+        print(f"Updated baseline {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print(f"No baseline found at {args.baseline}, run with --update-baseline to create one")
+        return
+    regressions, warnings = find_regressions(results, json.loads(args.baseline.read_text()))
+    if warnings:
+        print("WARNING: slower than the baseline:")
+        print("\n".join(warnings))
+    if regressions:
+        print("Regressions against the baseline:")
+        print("\n".join(regressions))
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
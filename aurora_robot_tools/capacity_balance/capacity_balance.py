@@ -12,15 +12,20 @@ The electrode matching is done in batches (defined in the input excel table), so
 within the same batch are switched around. This is useful if there are different cell chemistries
 within one run of the robot.
 
-Note: currently the script only moves the cathodes and not the anode positions. This means that each
-anode is tied to its target N:P ratio, so the sorting is not optimal if the user requires different
-N:P ratios within one batch of cells.
+Note: the 2D methods only move the cathodes and not the anode positions, so each anode is tied to its
+target N:P ratio. The 3D methods also move the N:P ratios between rows, while the casing, separator and
+electrolyte stay with the row. To keep every row's N:P ratio, casing and electrolyte together, use
+joint reassignment (method 11), which moves the anodes and cathodes instead.
+
+Each run prints the time spent reading, calculating capacities, solving each batch (with the number of
+cells, method used, solve status and optimality gap), rearranging and writing, and appends the same
+to the Performance_Log table, so slow runs can be diagnosed afterwards from a database backup.
 
 Usage:
     The script is called from capacity_balance.exe, which is called from the AutoSuite software.
     It can also be called from the command line.
 
-    There is one additional parameter that can be set:
+    There are two optional parameters that can be set with the command line call.
 
     - `sorting_method`:
         0 - Do not sort, do not check N:P ratio
@@ -34,31 +39,178 @@ Usage:
                 Optimal if N:P ratios are the same within batches
         4 - Use greedy 3D matching
                 Suboptimal, only use if N:P ratios differ and exact 3D is too slow
+                The greedy matching is improved by local search for up to LOCAL_SEARCH_SECONDS,
+                stopping early after LOCAL_SEARCH_PATIENCE perturbations without improvement
         5 - Use exact 3D matching
                 Optimal if N:P ratios differ within batches, but can be slow
+                Warm started from greedy matching, all batches share TIMEOUT_SECONDS with at least
+                MIN_BATCH_TIMEOUT_SECONDS each, if time runs out the best matching found so far is
+                used and the optimality gap is reported, or reported as unknown if CBC gives no bound
         6 - Choose automatically (default)
-                If N:P ratios do not change, use 2D matching (method 3), otherwise try exact 3D
-                (method 5), if too slow use greedy 3D (method 4)
-
-Todo:
-    - Make rejection_cost_factor an argument when AutoSuite supports it.
-    - [Long term] Pre-calculate the possible matchings using different rejection_cost_factors and
-      allow the user to choose the best one.
+                If N:P ratios do not change, use 2D matching (method 3). Otherwise, use exact 3D
+                matching (method 5) if its predicted solve time is within the latency budget, if not
+                use ratio class matching (method 8) if there are a few different N:P ratios, or
+                Lagrangian relaxation 3D matching (method 7). Solve times are predicted from the
+                batch size, number of different N:P ratios and fraction of infeasible anode-cathode
+                pairs, with a model calibrated by `py benchmark.py --calibrate`
+        7 - Use Lagrangian relaxation 3D matching
+                Near-optimal if N:P ratios differ within batches, fast, reports the optimality gap
+        8 - Use ratio class matching
+                Groups cells with the same N:P ratios, exact if there is one group, otherwise uses
+                Lagrangian relaxation with one multiplier per group
+        9 - Race greedy, ratio class and exact 3D matching in parallel processes
+                Uses the first matching proven to be optimal, or the lowest cost matching found
+                within TIMEOUT_SECONDS, the other solvers are stopped
+        10 - Use sparse 2D matching
+                For very large pools of electrodes, like method 3 but each anode is only matched
+                with up to SPARSE_CANDIDATES cathodes within its N:P ratio limits
+        11 - Use joint anode and cathode reassignment
+                The N:P ratio, casing, separator and electrolyte stay with each row, anodes and
+                cathodes are both moved between rows. Solved with ratio class matching, so it is exact
+                with one N:P ratio and uses polynomial-time Lagrangian relaxation otherwise
+
+    - `rejection_cost_factor` (float, default 2):
+        1 - No extra cost for rejecting, more rejected cells, better N:P ratio of accepted cells
+        10 - High cost to reject cells, fewer rejected cells, worse N:P ratio of accepted cells
+
+    Optional flags:
+
+    - `--sweep [FACTOR ...]`:
+        Before balancing, solve every batch for each rejection_cost_factor (default
+        REJECTION_COST_FACTORS) in parallel worker processes, and write the accepted cell count and
+        mean N:P deviation to the Balancing_Options_Table. The operator can then choose the factor to
+        use for the final run.
+    - `--parallel`:
+        Solve the batches at the same time in worker processes. All batches can use the full
+        TIMEOUT_SECONDS, so the total time is roughly that of the slowest batch. Batches waiting for
+        a free worker get the time left, but at least MIN_BATCH_TIMEOUT_SECONDS. Batches waiting for
+        a free worker get the time left, but at least MIN_BATCH_TIMEOUT_SECONDS.
+    - `--workers N`: number of worker processes, defaults to the number of CPUs.
+    - `--budget SECONDS`:
+        Latency budget for each batch when choosing the method automatically, defaults to
+        LATENCY_BUDGET_SECONDS.
+    - `--incremental`:
+        For batches using 2D matching (method 3, or method 6 with one N:P ratio), keep the dual
+        variables of the solution in the Balancing_State_Table and on the next run only re-solve the
+        electrodes which are new or have changed. Use when re-running after each weighing block.
+    - `--no-cache`:
+        Always solve every batch. By default the solution of each batch is stored in the
+        Balancing_Cache_Table, keyed by a hash of the electrode and N:P ratio columns, sorting method
+        and rejection cost factor, and the latency budget for method 6. Rerunning with the same values
+        applies the stored solution without solving, also when rerunning on the already rearranged
+        table. Solutions that depend on a time limit are only stored if they are proven optimal, a
+        greedy, Lagrangian or stopped exact matching is solved again. The CACHE_SIZE most recently
+        used entries are kept.
+
+    e.g. `py capacity_balance.py 6 3 --sweep`
 
 """
-import itertools
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import re
+import signal
 import sqlite3
+import subprocess
 import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import pulp
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_array
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import (
+    connect,
+    read_setting,
+    read_table,
+    table_columns,
+    update_table,
+    write_transaction,
+)
 
 DATABASE_FILEPATH = "C:\\Modules\\Database\\chemspeedDB.db"
 
 TIMEOUT_SECONDS = 30
 
+MIN_BATCH_TIMEOUT_SECONDS = 2
+
+LAGRANGIAN_TIMEOUT_SECONDS = 2
+
+LOCAL_SEARCH_SECONDS = 0.5
+
+LOCAL_SEARCH_PATIENCE = 200
+
+REJECTION_COST_FACTORS = [1, 1.5, 2, 3, 5, 10]
+
+SPARSE_CANDIDATES = 32
+
+PORTFOLIO_SOLVERS = ["greedy", "ratio class", "exact"]
+
+SOLVE_TIME_MODEL_FILEPATH = Path(__file__).parent / "solve_time_model.json"
+
+LATENCY_BUDGET_SECONDS = 5
+
+CACHE_SIZE = 50
+
+# Sorting methods whose solution does not depend on how long the solver ran
+UNTIMED_SORTING_METHODS = (0, 1, 2, 3, 10)
+
+PERFORMANCE_LOG_DTYPES = {
+    "Run Start": "TEXT",
+    "Phase": "TEXT",
+    "Batch Number": "INTEGER",
+    "Cells": "INTEGER",
+    "Sorting Method": "INTEGER",
+    "Rejection Cost Factor": "REAL",
+    "Status": "TEXT",
+    "Cost": "REAL",
+    "Lower Bound": "REAL",
+    "Gap": "REAL",
+    "Cost Matrix Seconds": "REAL",
+    "Seconds": "REAL",
+}
+
+# Columns read from the Cell_Assembly_Table, along with all anode and cathode columns which are moved
+CELL_ASSEMBLY_COLUMNS = [
+    "Rack Position",
+    "Batch Number",
+    "Last Completed Step",
+    "Error Code",
+    "Target N:P Ratio",
+    "Minimum N:P Ratio",
+    "Maximum N:P Ratio",
+    "N:P ratio overlap factor",
+    "Actual N:P Ratio",
+    "Cell Number",
+    "Sample ID",
+]
+
+FINGERPRINT_COLUMNS = [
+    f"{electrode} {value}"
+    for electrode in ("Anode", "Cathode")
+    for value in (
+        "Weight (mg)",
+        "Current Collector Weight (mg)",
+        "Active Material Weight Fraction",
+        "Balancing Specific Capacity (mAh/g)",
+        "Diameter (mm)",
+    )
+] + ["Target N:P Ratio", "Minimum N:P Ratio", "Maximum N:P Ratio"]
+
 
 def calculate_capacity(df: pd.DataFrame) -> None:
     """Calculate the capacity of the anodes and cathodes in-place in the main dataframe, df.
@@ -80,18 +232,15 @@ def calculate_capacity(df: pd.DataFrame) -> None:
             df.loc[df[f"{xode} Balancing Capacity (mAh)"] < 0, f"{xode} Balancing Capacity (mAh)"] = np.nan
 
 
-def cost_matrix_assign(df: pd.DataFrame, rejection_cost_factor: float = 2) -> tuple[list[int], list[int]]:
-    """Calculate the cost matrix and find the optimal matching of anodes and cathodes.
+def cost_matrix_2d(df: pd.DataFrame, rejection_cost_factor: float = 2) -> np.ndarray:
+    """Calculate the 2D cost matrix of anodes (rows) and cathodes (columns).
 
     Args:
         df (pandas.DataFrame): The dataframe containing the cell assembly data.
         rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
-            1 = no extra cost for rejecting, more rejected cells, better N:P ratio of accepted cells
-            10 = high cost to reject cells, fewer rejected cells, worse N:P ratio of accepted cells
-            2 = compromise
 
     Returns:
-        tuple: The indices of the optimal matching of anodes and cathodes.
+        numpy.ndarray: n x n cost matrix.
 
     """
     # Calculate all possible N:P ratios
@@ -119,7 +268,33 @@ def cost_matrix_assign(df: pd.DataFrame, rejection_cost_factor: float = 2) -> tu
         if np.isnan(cost_matrix[i, i]):
             cost_matrix[i, i] = 999.99999999
     # otherwise unassigned cells have the same cost
-    cost_matrix = np.nan_to_num(cost_matrix, nan=1000)
+    return np.nan_to_num(cost_matrix, nan=1000)
+
+
+def cost_matrix_assign(
+        df: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        stats: dict | None = None,
+    ) -> tuple[list[int], list[int]]:
+    """Calculate the cost matrix and find the optimal matching of anodes and cathodes.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+            1 = no extra cost for rejecting, more rejected cells, better N:P ratio of accepted cells
+            10 = high cost to reject cells, fewer rejected cells, worse N:P ratio of accepted cells
+            2 = compromise
+        stats (dict, optional): if given, the time to build the cost matrix is stored under
+            "Cost Matrix Seconds".
+
+    Returns:
+        tuple: The indices of the optimal matching of anodes and cathodes.
+
+    """
+    start_time = time.perf_counter()
+    cost_matrix = cost_matrix_2d(df, rejection_cost_factor)
+    if stats is not None:
+        stats["Cost Matrix Seconds"] = time.perf_counter() - start_time
 
     # Find the optimal matching of anodes and cathodes using linear sum assignment
     anode_ind, cathode_ind = linear_sum_assignment(cost_matrix, maximize=False)
@@ -127,82 +302,792 @@ def cost_matrix_assign(df: pd.DataFrame, rejection_cost_factor: float = 2) -> tu
     return anode_ind, cathode_ind
 
 
-def exact_npartite_matching(cost_matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Find the optimal matching of anodes and cathodes using an exact 3D matching algorithm.
+def sparse_candidates(
+        df: pd.DataFrame,
+        k: int = SPARSE_CANDIDATES,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find up to k cathodes for each anode which give an N:P ratio within the anode's limits.
+
+    The cathodes are sorted by capacity, so the cathodes within the N:P ratio limits of an anode are
+    a contiguous range, found with a binary search. The anodes are sorted by the ideal cathode
+    capacity (anode capacity / target N:P ratio), and each anode keeps the k cathodes in its range
+    closest to the cathode with the same rank. Centering on the rank rather than the ideal capacity
+    spreads anodes with similar capacities over different cathodes.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        k (int, optional): maximum number of cathodes per anode. Defaults to SPARSE_CANDIDATES.
+
+    Returns:
+        tuple: The anode indices, cathode indices and costs (deviation from the target N:P ratio)
+            of the candidate pairs.
 
-    This algorithm his NP-hard and can take a very long time for n>10
     """
-    # Get the size of the cost matrix
-    n = cost_matrix.shape[0]
+    n = len(df)
+    anode_capacity = (df["Anode Balancing Capacity (mAh)"]/df["Anode Diameter (mm)"]**2).to_numpy()
+    cathode_capacity = (df["Cathode Balancing Capacity (mAh)"]/df["Cathode Diameter (mm)"]**2).to_numpy()
+    target_ratio = df["Target N:P Ratio"].to_numpy()
+
+    # Sort the cathodes by capacity, cathodes without a capacity are sorted to the end
+    cathode_order = np.argsort(cathode_capacity)
+    sorted_capacity = cathode_capacity[cathode_order]
+    n_cathodes = np.count_nonzero(~np.isnan(cathode_capacity))
+
+    # N:P ratio = anode / cathode capacity, so find the range of cathode capacities within the limits
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower = np.searchsorted(sorted_capacity, anode_capacity / df["Maximum N:P Ratio"].to_numpy(), side="left")
+        upper = np.searchsorted(sorted_capacity, anode_capacity / df["Minimum N:P Ratio"].to_numpy(), side="right")
+        ideal_capacity = anode_capacity / target_ratio
+    upper = np.minimum(upper, n_cathodes)
+
+    # Keep a window of k cathodes around the cathode with the same rank, within the limits
+    anode_rank = np.empty(n, dtype=int)
+    anode_rank[np.argsort(ideal_capacity)] = np.arange(n)
+    n_anodes = max(np.count_nonzero(~np.isnan(ideal_capacity)), 1)
+    centre = anode_rank * n_cathodes // n_anodes
+    start = np.clip(centre - k // 2, lower, np.maximum(upper - k, lower))
+    counts = np.maximum(np.minimum(start + k, upper) - start, 0)
+    anode_ind = np.repeat(np.arange(n), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cathode_ind = cathode_order[np.repeat(start, counts) + offsets]
+    costs = np.abs(anode_capacity[anode_ind] / cathode_capacity[cathode_ind] - target_ratio[anode_ind])
+    return anode_ind, cathode_ind, costs
+
+
+def sparse_cost_matrix_assign(
+        df: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        k: int = SPARSE_CANDIDATES,
+    ) -> tuple[np.ndarray, np.ndarray]:
+    """Find the matching of anodes and cathodes using only k candidate cathodes for each anode.
+
+    For large pools of electrodes, the dense n x n cost matrix and linear sum assignment are slow
+    and use a lot of memory. Instead, each anode is only connected to up to k cathodes within its
+    N:P ratio limits, and to its own dummy rejection node. Every anode must be matched to a cathode
+    or its rejection node, cathodes can be left unmatched, so the n x 2n sparse problem is solved
+    with min_weight_full_bipartite_matching. Memory and time scale with n*k instead of n^2.
+
+    A rejected anode costs the smaller of the two rejection costs of the dense cost matrix
+    (maximum * rejection_cost_factor - target, or target - minimum / rejection_cost_factor), as it
+    is not known which cathode it will be paired with.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        k (int, optional): maximum number of cathodes per anode. Defaults to SPARSE_CANDIDATES.
+
+    Returns:
+        tuple: The indices of the matching of anodes and cathodes.
+
+    """
+    n = len(df)
+    anode_ind, cathode_ind, costs = sparse_candidates(df, k)
+    target_ratio = df["Target N:P Ratio"].to_numpy()
+    rejection_costs = np.nan_to_num(np.minimum(
+        df["Maximum N:P Ratio"].to_numpy() * rejection_cost_factor - target_ratio,
+        target_ratio - df["Minimum N:P Ratio"].to_numpy() / rejection_cost_factor,
+    ))
+    print(f"Matching {n} anodes and cathodes with {len(costs)} candidate pairs")
+
+    # Columns are the cathodes then the rejection node of each anode
+    # Every anode is matched once, so adding 1 to every weight does not change the optimum, but it
+    # avoids zero weights which would not be edges in the sparse matrix
+    rows = np.concatenate([anode_ind, np.arange(n)])
+    cols = np.concatenate([cathode_ind, n + np.arange(n)])
+    weights = np.concatenate([costs, rejection_costs]) + 1
+    row_ind, col_ind = min_weight_full_bipartite_matching(csr_array((weights, (rows, cols)), shape=(n, 2 * n)))
+    anode_match = np.empty(n, dtype=int)
+    anode_match[row_ind] = col_ind
+
+    # Pair up the rejected anodes and unused cathodes, keeping them in place where possible
+    accepted = anode_match < n
+    cathode_ind = np.where(accepted, anode_match, -1)
+    rejected_anodes = np.where(~accepted)[0]
+    unused_cathodes = np.setdiff1d(np.arange(n), anode_match[accepted])
+    unmoved = np.intersect1d(rejected_anodes, unused_cathodes)
+    cathode_ind[unmoved] = unmoved
+    cathode_ind[np.setdiff1d(rejected_anodes, unmoved)] = np.setdiff1d(unused_cathodes, unmoved)
+    return np.arange(n), cathode_ind
+
+
+def augment_assignment(
+        cost_matrix: np.ndarray,
+        row_dual: np.ndarray,
+        col_dual: np.ndarray,
+        col_for_row: np.ndarray,
+        row_for_col: np.ndarray,
+        free_rows: np.ndarray,
+    ) -> None:
+    """Assign free rows along shortest augmenting paths, updating the assignment and duals in-place.
+
+    This is the augmentation step of the Hungarian (Jonker-Volgenant) algorithm. The dual variables
+    must be feasible (cost - row_dual - col_dual >= 0) and tight for every assigned pair. Each
+    augmentation keeps this true, so the assignment is optimal once every row is assigned. Unassigned
+    rows and columns are marked with -1 in col_for_row and row_for_col.
+
+    Args:
+        cost_matrix (numpy.ndarray): n x n cost matrix.
+        row_dual (numpy.ndarray): dual variable of each row.
+        col_dual (numpy.ndarray): dual variable of each column.
+        col_for_row (numpy.ndarray): assigned column of each row.
+        row_for_col (numpy.ndarray): assigned row of each column.
+        free_rows (numpy.ndarray): rows to assign.
+
+    """
+    n = cost_matrix.shape[1]
+    for current_row in free_rows:
+        # Dijkstra search on reduced costs from the free row to the nearest free column
+        path_cost = np.full(n, np.inf)
+        previous_row = np.full(n, -1)
+        scanned_cols = np.zeros(n, dtype=bool)
+        scanned_rows = []
+        row = current_row
+        min_value = 0.0
+        while True:
+            reduced_cost = min_value + cost_matrix[row] - row_dual[row] - col_dual
+            shorter = ~scanned_cols & (reduced_cost < path_cost)
+            path_cost[shorter] = reduced_cost[shorter]
+            previous_row[shorter] = row
+            col = int(np.argmin(np.where(scanned_cols, np.inf, path_cost)))
+            min_value = path_cost[col]
+            scanned_cols[col] = True
+            if row_for_col[col] == -1:
+                break
+            row = row_for_col[col]
+            scanned_rows.append(row)
+
+        # Update the duals so the path becomes tight
+        row_dual[current_row] += min_value
+        scanned_rows = np.array(scanned_rows, dtype=int)
+        row_dual[scanned_rows] += min_value - path_cost[col_for_row[scanned_rows]]
+        col_dual[scanned_cols] -= min_value - path_cost[scanned_cols]
+
+        # Flip the assignment along the path
+        while True:
+            row = previous_row[col]
+            row_for_col[col] = row
+            col_for_row[row], col = col, col_for_row[row]
+            if row == current_row:
+                break
+
+
+def incremental_cost_matrix_assign(
+        df_batch: pd.DataFrame,
+        batch_number: float,
+        df_state: pd.DataFrame | None,
+        rejection_cost_factor: float = 2,
+    ) -> tuple[np.ndarray, np.ndarray, pd.DataFrame]:
+    """Update the 2D matching of a batch from the previous run, only re-solving changed electrodes.
+
+    The previous run already rearranged the database, so each row holds a matched anode and cathode.
+    The dual variables of the previous solution are stored per electrode rack position along with the
+    values that determine its costs. Anodes and cathodes that are new or whose values changed are
+    unassigned and their duals reset to feasible values, then only those rows are re-assigned with
+    augment_assignment. With no stored state every row is assigned, which gives the full solution.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        batch_number (float): The batch number.
+        df_state (pandas.DataFrame or None): The stored Balancing_State_Table, if it exists.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+
+    Returns:
+        tuple: The anode and cathode indices, and the new state of this batch.
+
+    """
+    start_time = time.perf_counter()
+    n = len(df_batch)
+    cost_matrix = cost_matrix_2d(df_batch, rejection_cost_factor)
+
+    # Values which determine the cost of each anode (row) and cathode (column)
+    anode_values = np.column_stack([
+        (df_batch["Anode Balancing Capacity (mAh)"] / df_batch["Anode Diameter (mm)"]**2).to_numpy(),
+        df_batch["Target N:P Ratio"].to_numpy(),
+        df_batch["Minimum N:P Ratio"].to_numpy(),
+        df_batch["Maximum N:P Ratio"].to_numpy(),
+        np.full(n, rejection_cost_factor),
+    ])
+    cathode_values = np.column_stack([
+        (df_batch["Cathode Balancing Capacity (mAh)"] / df_batch["Cathode Diameter (mm)"]**2).to_numpy(),
+        np.full((n, 3), np.nan),
+        np.full(n, rejection_cost_factor),
+    ])
+    value_columns = ["Normalised Capacity", "Target N:P Ratio", "Minimum N:P Ratio", "Maximum N:P Ratio",
+                     "Rejection Cost Factor"]
+    anode_positions = df_batch["Anode Rack Position"].to_numpy()
+    cathode_positions = df_batch["Cathode Rack Position"].to_numpy()
+
+    # Look up the stored duals, electrodes which are new or changed are dirty
+    row_dual = np.zeros(n)
+    col_dual = np.zeros(n)
+    dirty_rows = np.ones(n, dtype=bool)
+    dirty_cols = np.ones(n, dtype=bool)
+    if df_state is not None:
+        df_state = df_state[df_state["Batch Number"] == batch_number]
+        for electrode, positions, values, dual, dirty in (
+            ("Anode", anode_positions, anode_values, row_dual, dirty_rows),
+            ("Cathode", cathode_positions, cathode_values, col_dual, dirty_cols),
+        ):
+            df_stored = (
+                df_state[df_state["Electrode"] == electrode]
+                .drop_duplicates("Rack Position")
+                .set_index("Rack Position")
+                .reindex(positions)
+            )
+            stored_values = df_stored[value_columns].to_numpy(dtype=float)
+            unchanged = np.isclose(stored_values, values, rtol=1e-12, atol=0, equal_nan=True).all(axis=1)
+            dirty[:] = ~unchanged
+            dual[unchanged] = df_stored["Dual"].to_numpy(dtype=float)[unchanged]
+
+    # Each row is matched with its own cathode, unassign rows with a dirty anode or cathode
+    col_for_row = np.arange(n)
+    row_for_col = np.arange(n)
+    free_rows = dirty_rows | dirty_cols
+    col_for_row[free_rows] = -1
+    row_for_col[free_rows] = -1
+
+    # Reset the duals of dirty columns and free rows so all reduced costs are non-negative
+    clean_rows = ~free_rows
+    if clean_rows.any():
+        col_dual[dirty_cols] = (cost_matrix[clean_rows][:, dirty_cols] - row_dual[clean_rows, np.newaxis]).min(axis=0)
+    else:
+        col_dual[:] = 0
+    row_dual[free_rows] = (cost_matrix[free_rows] - col_dual).min(axis=1)
+
+    # Any other row that is no longer feasible or tight is also re-solved
+    reduced_cost = cost_matrix - row_dual[:, np.newaxis] - col_dual
+    infeasible = clean_rows & (
+        (reduced_cost.min(axis=1) < -1e-9) | (np.abs(reduced_cost[np.arange(n), np.arange(n)]) > 1e-9)
+    )
+    if infeasible.any():
+        col_for_row[infeasible] = -1
+        row_for_col[infeasible] = -1
+        free_rows |= infeasible
+        row_dual[infeasible] = (cost_matrix[infeasible] - col_dual).min(axis=1)
+
+    augment_assignment(cost_matrix, row_dual, col_dual, col_for_row, row_for_col, np.where(free_rows)[0])
+    print(f"Incrementally re-solved {free_rows.sum()} of {n} rows in "
+          f"{1000 * (time.perf_counter() - start_time):.1f} ms")
+
+    # Store the values and duals of every electrode for the next run
+    df_new_state = pd.concat([
+        pd.DataFrame(values, columns=value_columns).assign(
+            **{"Batch Number": batch_number, "Electrode": electrode, "Rack Position": positions, "Dual": dual},
+        )
+        for electrode, positions, values, dual in (
+            ("Anode", anode_positions, anode_values, row_dual),
+            ("Cathode", cathode_positions, cathode_values, col_dual),
+        )
+    ], ignore_index=True)
+    return np.arange(n), col_for_row, df_new_state
+
 
-    # Create a list of all possible assignments (each assignment is a tuple of 3 indices)
-    assignments = list(itertools.product(range(n), repeat=3))
+def build_3d_assignment_model(
+        cost_matrix: np.ndarray,
+        rejection_cost: float = 2,
+    ) -> tuple[pulp.LpProblem, dict[tuple[int, int, int], pulp.LpVariable], list[list[pulp.LpVariable]]]:
+    """Build a sparse MILP model for the 3D assignment problem.
 
-    # Create a binary variable for each assignment
-    x = pulp.LpVariable.dicts("x", assignments, cat=pulp.LpBinary)
+    Only triples with a cost below the rejection cost get a binary variable. Every other rejected
+    triple has the same cost, so instead of enumerating them each anode, cathode and ratio index gets
+    a slack variable which is 1 if the index is not part of an accepted triple. The anode slack
+    carries the rejection cost, the leftover indices are matched up after solving.
 
-    # Create the problem
+    An index with a missing electrode or ratio (a slice costing at least 999.999) is always rejected,
+    and the leftover triples need at least as many triples costing 1000 as there are missing
+    indices left over on any axis. This number is a variable with the extra cost over a rejected
+    triple. The diagonal triples of missing indices cost 999.999, so they get a binary variable too.
+    The optimum of the model is then the optimum of the cost matrix, when the leftover indices are
+    matched up with complete_npartite_matching.
+
+    Variables are indexed by each axis while they are created, so building the constraints is linear
+    in the number of accepted triples rather than O(n^4).
+
+    Args:
+        cost_matrix (numpy.ndarray): n x n x n cost matrix.
+        rejection_cost (float, optional): cost of a rejected triple. Defaults to 2.
+
+    Returns:
+        tuple: The PuLP problem, a dict of the binary variables keyed by (anode, cathode, ratio),
+            and the slack variables of each axis.
+
+    """
+    start_time = time.perf_counter()
+    n = cost_matrix.shape[0]
+
+    # Only keep triples which are not rejected, and the diagonal triples of missing indices
+    triples = np.argwhere((cost_matrix < rejection_cost) | ((cost_matrix >= 999.999) & (cost_matrix < 1000)))
+    costs = cost_matrix[tuple(triples.T)]
+
+    # Create a binary variable for each triple, and index them by anode, cathode and ratio
+    x = {}
+    objective = []
+    axis_vars = [[[] for _ in range(n)] for _ in range(3)]
+    for (i, j, k), cost in zip(triples.tolist(), costs.tolist()):
+        var = pulp.LpVariable(f"x_{i}_{j}_{k}", cat=pulp.LpBinary)
+        x[(i, j, k)] = var
+        objective.append((var, cost))
+        axis_vars[0][i].append(var)
+        axis_vars[1][j].append(var)
+        axis_vars[2][k].append(var)
+
+    # Slack variables are 1 if the index is left over for a rejected triple
+    slack = [[pulp.LpVariable(f"s_{axis}_{i}", lowBound=0, upBound=1) for i in range(n)] for axis in range(3)]
+
+    # Number of leftover triples with a missing index, each costs 1000 instead of the rejection cost
+    missing = [
+        np.where((cost_matrix >= 999.999).all(axis=axes))[0] for axes in [(1, 2), (0, 2), (0, 1)]
+    ]
+    missing_triples = pulp.LpVariable("missing_triples", lowBound=0)
+
+    # The objective is to minimize the total cost of accepted and rejected triples
     problem = pulp.LpProblem("3D_assignment", pulp.LpMinimize)
+    problem += pulp.LpAffineExpression(
+        objective + [(s, rejection_cost) for s in slack[0]] + [(missing_triples, 1000 - rejection_cost)],
+    )
 
-    # The objective is to minimize the total cost of the chosen assignments
-    problem += pulp.lpSum(cost_matrix[a]*x[a] for a in assignments)
+    # Add constraints ensuring each anode, cathode and ratio is used exactly once
+    for axis in range(3):
+        for i in range(n):
+            problem += pulp.lpSum(axis_vars[axis][i]) + slack[axis][i] == 1
+        if len(missing[axis]) > 0:
+            problem += missing_triples >= pulp.lpSum(slack[axis][i] for i in missing[axis])
+
+    build_time = time.perf_counter() - start_time
+    print(f"Built exact matching model with {len(x)} of {n**3} triples, "
+          f"{problem.numVariables()} variables and {problem.numConstraints()} constraints "
+          f"in {build_time:.2f} seconds")
+    return problem, x, slack
+
+
+def complete_npartite_matching(
+        cost_matrix: np.ndarray,
+        i_idx: np.ndarray,
+        j_idx: np.ndarray,
+        k_idx: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Match up the anodes, cathodes and ratios not used in a partial 3D matching.
 
-    # Add constraints ensuring each x, y, and z is used exactly once
-    for i in range(n):
-        problem += pulp.lpSum(x[a] for a in assignments if a[0] == i) == 1
-        problem += pulp.lpSum(x[a] for a in assignments if a[1] == i) == 1
-        problem += pulp.lpSum(x[a] for a in assignments if a[2] == i) == 1
-
-    # Solve the problem
-    print(f"Attempting exact matching, will give up if a solution not found in {TIMEOUT_SECONDS} seconds...")
-    problem.solve(pulp.PULP_CBC_CMD(options=[f"sec={TIMEOUT_SECONDS}"],msg=False))
-    if pulp.LpStatus[problem.status] != "Optimal":
-        msg = f"Optimal solution not found. Status: {pulp.LpStatus[problem.status]}"
+    The left over indices are matched with the greedy algorithm, which first uses the rejected
+    triples without a missing electrode, so the missing electrodes end up in as few triples as
+    possible. Ties keep the missing electrodes in place, as the diagonal costs slightly less.
+    """
+    rest = []
+    for used in (i_idx, j_idx, k_idx):
+        mask = np.ones(cost_matrix.shape[0], dtype=bool)
+        mask[used] = False
+        rest.append(np.where(mask)[0])
+    i_rest, j_rest, k_rest = (np.array([], dtype=int) for _ in range(3))
+    if len(rest[0]) > 0:
+        i_sub, j_sub, k_sub = greedy_npartite_matching(cost_matrix[np.ix_(*rest)])
+        i_rest, j_rest, k_rest = rest[0][i_sub], rest[1][j_sub], rest[2][k_sub]
+    return (
+        np.concatenate([i_idx, i_rest]).astype(int),
+        np.concatenate([j_idx, j_rest]).astype(int),
+        np.concatenate([k_idx, k_rest]).astype(int),
+    )
+
+
+def exact_npartite_matching(
+        cost_matrix: np.ndarray,
+        rejection_cost: float = 2,
+        deadline: float | None = None,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """Find the optimal matching of anodes and cathodes using an exact 3D matching algorithm.
+
+    This algorithm is NP-hard and can take a very long time for n>10, so it is run as an anytime
+    algorithm. The initial matching is given to the solver as a warm start, and if the deadline is
+    reached the best feasible matching found so far is returned along with the solver's lower bound.
+    The result is never worse than the initial matching.
+
+    Args:
+        cost_matrix (numpy.ndarray): n x n x n cost matrix.
+        rejection_cost (float, optional): cost of a rejected triple. Defaults to 2.
+        deadline (float, optional): time.perf_counter() time to stop the solver. Defaults to
+            TIMEOUT_SECONDS from now.
+        initial (tuple, optional): anode, cathode and ratio indices of a known matching, e.g. from
+            the greedy algorithm, used as the warm start and fallback.
+
+    Returns:
+        tuple: The anode, cathode and ratio indices of the best matching, and the lower bound on
+            the total cost. The lower bound is None if the solver stopped early and its log did
+            not give one, so the gap is unknown.
+
+    """
+    if deadline is None:
+        deadline = time.perf_counter() + TIMEOUT_SECONDS
+    problem, x, slack = build_3d_assignment_model(cost_matrix, rejection_cost)
+
+    # Set the initial matching as the warm start
+    if initial is not None:
+        for var in x.values():
+            var.setInitialValue(0)
+        for axis_slack in slack:
+            for var in axis_slack:
+                var.setInitialValue(1)
+        for i, j, k in zip(*initial):
+            if (i, j, k) in x:
+                x[(i, j, k)].setInitialValue(1)
+                slack[0][i].setInitialValue(0)
+                slack[1][j].setInitialValue(0)
+                slack[2][k].setInitialValue(0)
+
+    # Solve the problem, CBC writes the lower bound to its log if it stops early
+    time_limit = max(deadline - time.perf_counter(), 1)
+    print(f"Attempting exact matching, will stop and use the best solution found after {time_limit:.1f} seconds...")
+    start_time = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log_path = Path(tmpdir) / "cbc.log"
+        problem.solve(pulp.PULP_CBC_CMD(
+            timeLimit=time_limit, warmStart=initial is not None, msg=False, logPath=str(log_path),
+        ))
+        log = log_path.read_text() if log_path.exists() else ""
+    solve_time = time.perf_counter() - start_time
+    # PuLP reports the status as optimal if CBC stops on time with a feasible solution, so only
+    # trust the result line of the log. Without binary variables the model is solved as an LP,
+    # which always finishes and does not write the result line.
+    has_solution = problem.sol_status in (pulp.LpSolutionOptimal, pulp.LpSolutionIntegerFeasible)
+    optimal = has_solution and (
+        not x or re.search(r"^Result - Optimal solution found", log, re.MULTILINE) is not None
+    )
+    model_bound = pulp.value(problem.objective) if optimal else None
+    if not optimal:
+        # The partial search line has the bound in full precision, the summary rounds it
+        bound_match = (
+            re.search(r"best possible ([-+.\deE]+)\)", log)
+            or re.search(r"^Lower bound:\s*([-+.\deE]+)", log, re.MULTILINE)
+        )
+        with contextlib.suppress(ValueError):
+            model_bound = float(bound_match.group(1)) if bound_match else None
+
+    # Get the accepted assignments, then match up the rejected electrodes
+    if has_solution:
+        assignments = np.array([a for a, var in x.items() if var.value() > 0.5], dtype=int).reshape(-1, 3)
+        i_idx, j_idx, k_idx = complete_npartite_matching(
+            cost_matrix, assignments[:,0], assignments[:,1], assignments[:,2],
+        )
+    elif initial is None:
+        msg = f"No solution found after {solve_time:.2f} seconds. Status: {pulp.LpStatus[problem.status]}"
         raise ValueError(msg)
-    print("Optimal solution found")
-    # Get the optimal assignments
-    optimal_assignments = np.array([a for a in assignments if pulp.value(x[a]) == 1])
-    i_idx, j_idx, k_idx = optimal_assignments[:,0], optimal_assignments[:,1], optimal_assignments[:,2]
-    return i_idx, j_idx, k_idx
+    else:
+        print(f"No solution found after {solve_time:.2f} seconds, using the initial matching")
+    if initial is not None and (
+        not has_solution or cost_matrix[initial].sum() < cost_matrix[i_idx, j_idx, k_idx].sum()
+    ):
+        i_idx, j_idx, k_idx = (np.asarray(idx) for idx in initial)
+
+    cost = cost_matrix[i_idx, j_idx, k_idx].sum()
+    if model_bound is None:
+        lower_bound = None
+        print(f"Stopped exact matching after {solve_time:.2f} seconds, best cost {cost:.4f}, "
+              "lower bound and gap unknown")
+    else:
+        # The matching is only optimal if matching up the leftover indices reached the model bound
+        lower_bound = min(model_bound, cost)
+        if cost - lower_bound < 1e-6:
+            print(f"Optimal solution found in {solve_time:.2f} seconds, cost {cost:.4f}")
+        else:
+            print(f"{'Solved' if optimal else 'Stopped'} exact matching after {solve_time:.2f} seconds, "
+                  f"best cost {cost:.4f}, lower bound {lower_bound:.4f}, gap {cost - lower_bound:.4f}")
+    return i_idx, j_idx, k_idx, lower_bound
 
 
-def greedy_npartite_matching(cost_matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+def greedy_npartite_matching(
+        cost_matrix: np.ndarray,
+        improve_seconds: float = 0,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Find the optimal matching of anodes, cathodes, and target ratios using a greedy algorithm.
 
     This will find a suboptimal solution, but does not suffer from combinatoral explosion like the
-    exact method.
+    exact method. The triples are sorted by cost once, then walked through in blocks, using boolean
+    masks to skip triples with an index that is already used.
+
+    Args:
+        cost_matrix (numpy.ndarray): n x n x n cost matrix.
+        improve_seconds (float, optional): time to spend improving the greedy matching with local
+            search (improve_npartite_matching). Defaults to 0, no improvement.
+
+    Returns:
+        tuple: The anode, cathode and ratio indices of the matching.
+
     """
     # Get the shape of the cost matrix
     n = cost_matrix.shape[0]
 
-    # Create a list of all possible assignments (each assignment is a tuple of 3 indices)
-    assignments = [(i, j, k) for i in range(n) for j in range(n) for k in range(n)]
+    # Sort all assignments by cost, ties keep the (i, j, k) order
+    order = np.argsort(cost_matrix, axis=None, kind="stable")
+
+    # Initialize the masks of used indices for each dimension
+    used = np.zeros((3, n), dtype=bool)
+    chosen_assignments = np.empty((n, 3), dtype=int)
+    n_chosen = 0
+
+    # Walk through the sorted assignments, choosing the first with no used indices
+    block_size = max(n * n, 1024)
+    position = 0
+    while n_chosen < n and position < order.size:
+        i, j, k = np.unravel_index(order[position:position + block_size], cost_matrix.shape)
+        free = ~(used[0, i] | used[1, j] | used[2, k])
+        if not free.any():
+            position += len(i)
+            continue
+        first = np.argmax(free)
+        chosen_assignments[n_chosen] = i[first], j[first], k[first]
+        used[0, i[first]] = used[1, j[first]] = used[2, k[first]] = True
+        n_chosen += 1
+        position += first + 1
+    i_idx, j_idx, k_idx = chosen_assignments[:,0], chosen_assignments[:,1], chosen_assignments[:,2]
 
-    # Sort the assignments by cost
-    assignments.sort(key=lambda a: cost_matrix[a])
+    # Optionally improve the greedy matching with local search
+    if improve_seconds > 0:
+        greedy_cost = cost_matrix[i_idx, j_idx, k_idx].sum()
+        i_idx, j_idx, k_idx = local_search_npartite_matching(cost_matrix, i_idx, j_idx, k_idx, improve_seconds)
+        print(f"Improved greedy matching cost from {greedy_cost:.4f} to "
+              f"{cost_matrix[i_idx, j_idx, k_idx].sum():.4f}")
+    return i_idx, j_idx, k_idx
 
-    # Initialize the set of used indices for each dimension
-    used_indices = [set() for _ in range(3)]
 
-    # Initialize the list of chosen assignments
-    chosen_assignments = []
+def improve_npartite_matching(
+        cost_matrix: np.ndarray,
+        i_idx: np.ndarray,
+        j_idx: np.ndarray,
+        k_idx: np.ndarray,
+        deadline: float | None = None,
+        capacities: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Improve a 3D matching by reassigning one dimension at a time.
 
-    # Iterate over the sorted assignments
-    for a in assignments:
-        # If the indices of this assignment have not been used yet, choose this assignment
-        if all(a[i] not in used_indices[i] for i in range(3)):
-            chosen_assignments.append(a)
-            for i in range(3):
-                used_indices[i].add(a[i])
-    chosen_assignments = np.array(chosen_assignments)
-    i_idx, j_idx, k_idx = chosen_assignments[:,0], chosen_assignments[:,1], chosen_assignments[:,2]
-    return i_idx, j_idx, k_idx
+    With two indices of every chosen triple fixed, the best way to reassign the third index is a 2D
+    assignment problem, which is solved exactly with linear sum assignment. This includes every swap
+    or cycle of swaps within that dimension. The dimensions are cycled through until none of them
+    improves the cost, or until the deadline (from time.perf_counter) is reached.
+
+    If capacities are given, the third dimension of the cost matrix is a ratio class which can be
+    used capacities[k] times, instead of a single ratio.
+    """
+    n = cost_matrix.shape[0]
+    if capacities is None:
+        capacities = np.ones(cost_matrix.shape[2], dtype=int)
+    slot_index = [np.arange(n), np.arange(n), np.repeat(np.arange(len(capacities)), capacities)]
+    idx = [np.asarray(i_idx), np.asarray(j_idx), np.asarray(k_idx)]
+    cost = cost_matrix[tuple(idx)].sum()
+    axis = 2
+    axes_without_improvement = 0
+    while axes_without_improvement < 3:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        # Cost of giving chosen triple p the index q in this dimension
+        sub_cost = cost_matrix[tuple(
+            slot_index[a][np.newaxis, :] if a == axis else idx[a][:, np.newaxis] for a in range(3)
+        )]
+        _, new_slots = linear_sum_assignment(sub_cost)
+        new_cost = sub_cost[np.arange(n), new_slots].sum()
+        if new_cost < cost - 1e-9:
+            idx[axis] = slot_index[axis][new_slots]
+            cost = new_cost
+            axes_without_improvement = 0
+        else:
+            axes_without_improvement += 1
+        axis = (axis + 1) % 3
+    return idx[0], idx[1], idx[2]
+
+
+def local_search_npartite_matching(
+        cost_matrix: np.ndarray,
+        i_idx: np.ndarray,
+        j_idx: np.ndarray,
+        k_idx: np.ndarray,
+        seconds: float,
+        seed: int = 0,
+        patience: int = LOCAL_SEARCH_PATIENCE,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Improve a 3D matching with iterated local search for up to a fixed time.
+
+    The matching is improved with improve_npartite_matching until no dimension can be improved.
+    Then the cathodes or ratios of a random fifth of the triples are shuffled and the result is
+    improved again, keeping it if the cost is lower, until the time runs out or patience shuffles
+    in a row bring no improvement. Small batches converge in a few milliseconds, so they stop long
+    before the time limit.
+    """
+    n = cost_matrix.shape[0]
+    deadline = time.perf_counter() + seconds
+    rng = np.random.default_rng(seed)
+    best_idx = improve_npartite_matching(cost_matrix, i_idx, j_idx, k_idx, deadline=deadline)
+    best_cost = cost_matrix[best_idx].sum()
+    rounds_without_improvement = 0
+    while n > 1 and rounds_without_improvement < patience and time.perf_counter() < deadline:
+        trial_idx = list(best_idx)
+        axis = rng.integers(1, 3)
+        shuffled = rng.choice(n, size=max(2, n // 5), replace=False)
+        trial_idx[axis] = trial_idx[axis].copy()
+        trial_idx[axis][shuffled] = trial_idx[axis][rng.permutation(shuffled)]
+        trial_idx = improve_npartite_matching(cost_matrix, *trial_idx, deadline=deadline)
+        trial_cost = cost_matrix[trial_idx].sum()
+        if trial_cost < best_cost - 1e-9:
+            best_idx, best_cost = trial_idx, trial_cost
+            rounds_without_improvement = 0
+        else:
+            rounds_without_improvement += 1
+    return best_idx
+
+
+def lagrangian_npartite_matching(
+        cost_matrix: np.ndarray,
+        timeout: float = LAGRANGIAN_TIMEOUT_SECONDS,
+        max_iterations: int = 1000,
+        capacities: np.ndarray | None = None,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """Find a near-optimal matching of anodes, cathodes and ratios with Lagrangian relaxation.
+
+    The constraint that each ratio is used once is relaxed with a multiplier per ratio. The relaxed
+    problem is a 2D assignment, where each anode-cathode pair takes its cheapest ratio after
+    subtracting the multipliers, solved with linear sum assignment. Its cost is a lower bound on the
+    optimal cost. Every iteration the anode-cathode pairs are repaired into a feasible matching, and
+    the multipliers are updated with a subgradient step, until the gap closes or time runs out.
+
+    Args:
+        cost_matrix (numpy.ndarray): n x n x n cost matrix, or n x n x m for m ratio classes.
+        timeout (float, optional): time limit in seconds. Defaults to LAGRANGIAN_TIMEOUT_SECONDS.
+        max_iterations (int, optional): maximum number of subgradient steps. Defaults to 1000.
+        capacities (numpy.ndarray, optional): number of cells in each ratio class, if the third
+            dimension of the cost matrix is ratio classes. Defaults to one cell per ratio.
+        initial (tuple, optional): anode, cathode and ratio indices of a known matching to start
+            from, e.g. the solution for a different rejection_cost_factor.
+
+    Returns:
+        tuple: The anode, cathode and ratio indices of the best matching found, and a lower bound on
+            the optimal cost.
+
+    """
+    n = cost_matrix.shape[0]
+    if capacities is None:
+        capacities = np.ones(cost_matrix.shape[2], dtype=int)
+    slot_index = np.repeat(np.arange(len(capacities)), capacities)
+    deadline = time.perf_counter() + timeout
+    multipliers = np.zeros(len(capacities))
+    step_scale = 2.0
+    lower_bound = -np.inf
+    upper_bound = np.inf
+    best_idx = (np.arange(n), np.arange(n), np.arange(n))
+    if initial is not None:
+        best_idx = improve_npartite_matching(cost_matrix, *initial, deadline=deadline, capacities=capacities)
+        upper_bound = cost_matrix[best_idx].sum()
+    iterations_without_improvement = 0
+
+    for _iteration in range(max_iterations):
+        # Solve the relaxed problem, each pair uses the ratio with the lowest adjusted cost
+        adjusted_cost = cost_matrix - multipliers[np.newaxis, np.newaxis, :]
+        pair_ratio = adjusted_cost.argmin(axis=2)
+        pair_cost = np.take_along_axis(adjusted_cost, pair_ratio[:, :, np.newaxis], axis=2)[:, :, 0]
+        i_idx, j_idx = linear_sum_assignment(pair_cost)
+        relaxed_bound = pair_cost[i_idx, j_idx].sum() + capacities @ multipliers
+        if relaxed_bound > lower_bound + 1e-9:
+            lower_bound = relaxed_bound
+            iterations_without_improvement = 0
+        else:
+            iterations_without_improvement += 1
+            if iterations_without_improvement >= 10:
+                step_scale /= 2
+                iterations_without_improvement = 0
+
+        # Repair the relaxed solution by assigning the ratios to the pairs, then improve it
+        _, k_slots = linear_sum_assignment(cost_matrix[i_idx[:, np.newaxis], j_idx[:, np.newaxis], slot_index])
+        repaired_idx = improve_npartite_matching(
+            cost_matrix, i_idx, j_idx, slot_index[k_slots], deadline=deadline, capacities=capacities,
+        )
+        repaired_cost = cost_matrix[repaired_idx].sum()
+        if repaired_cost < upper_bound:
+            upper_bound = repaired_cost
+            best_idx = repaired_idx
+
+        # Subgradient step, a zero subgradient means the relaxed solution is feasible and optimal
+        subgradient = capacities - np.bincount(pair_ratio[i_idx, j_idx], minlength=len(capacities))
+        norm = (subgradient**2).sum()
+        if (
+            norm == 0
+            or upper_bound - lower_bound <= 1e-6 * max(1, abs(upper_bound))
+            or step_scale < 1e-6
+            or time.perf_counter() > deadline
+        ):
+            break
+        multipliers += step_scale * (upper_bound - relaxed_bound) / norm * subgradient
+
+    lower_bound = min(lower_bound, upper_bound)
+    print(f"Lagrangian matching cost {upper_bound:.4f}, lower bound {lower_bound:.4f}, "
+          f"gap {upper_bound - lower_bound:.4f}")
+    return best_idx[0], best_idx[1], best_idx[2], lower_bound
+
+
+def cost_matrix_3d(
+        df: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        ratio_classes: np.ndarray | None = None,
+        dtype: type = np.float64,
+    ) -> np.ndarray:
+    """Calculate the normalised 3D cost matrix of anodes, cathodes and N:P ratios.
+
+    The cost is the deviation of the N:P ratio from the target, divided by the allowed deviation
+    (target - minimum below the target, maximum - target above). The matrix is calculated by
+    broadcasting the 1D arrays and with in-place operations, so only the cost matrix and one boolean
+    mask of the same shape are allocated.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        ratio_classes (numpy.ndarray, optional): ratio class of each row, the third dimension of the
+            cost matrix then has one entry per class. Defaults to one entry per row.
+        dtype (type, optional): data type of the cost matrix, use np.float32 to halve the memory
+            for large batches. Defaults to np.float64.
+
+    Returns:
+        numpy.ndarray: n x n x m cost matrix, for n cells and m ratios.
+
+    """
+    n = len(df)
+    if ratio_classes is None:
+        ratio_classes = np.arange(n)
+    _, ratio_rows = np.unique(ratio_classes, return_index=True)
+    m = len(ratio_rows)
+    memory_mb = n * n * m * (np.dtype(dtype).itemsize + 1) / 1e6
+    print(f"Calculating {n}x{n}x{m} cost matrix, needs approximately {memory_mb:.1f} MB")
+
+    anode_capacity = (df["Anode Balancing Capacity (mAh)"]/df["Anode Diameter (mm)"]**2).to_numpy(dtype)
+    cathode_capacity = (df["Cathode Balancing Capacity (mAh)"]/df["Cathode Diameter (mm)"]**2).to_numpy(dtype)
+    target_ratio = df["Target N:P Ratio"].to_numpy(dtype)[ratio_rows]
+    min_ratio = df["Minimum N:P Ratio"].to_numpy(dtype)[ratio_rows]
+    max_ratio = df["Maximum N:P Ratio"].to_numpy(dtype)[ratio_rows]
+
+    # Calculate the 3D cost matrix, actual ratio of every anode-cathode pair minus every target
+    cost_matrix = np.empty((n, n, m), dtype=dtype)
+    actual_ratio = np.divide.outer(anode_capacity, cathode_capacity)
+    np.subtract(actual_ratio[:, :, np.newaxis], target_ratio, out=cost_matrix)
+
+    # If the cost diff is negative, divide by (min_ratio - target_ratio), otherwise by (max_ratio - target_ratio)
+    mask = cost_matrix < 0
+    np.divide(cost_matrix, min_ratio - target_ratio, out=cost_matrix, where=mask)
+    np.logical_not(mask, out=mask)
+    np.divide(cost_matrix, max_ratio - target_ratio, out=cost_matrix, where=mask)
+
+    # If the normalised cost is over 1 the cell is rejected, so set the cost to the rejection_cost_factor
+    np.greater(cost_matrix, 1, out=mask)
+    cost_matrix[mask] = rejection_cost_factor
+
+    # Set NaNs to a very large number, diagonal elements slightly less so unassigned electrodes are not moved
+    diagonal = (np.arange(n), np.arange(n), ratio_classes)
+    cost_matrix[diagonal] = np.where(np.isnan(cost_matrix[diagonal]), 999.999, cost_matrix[diagonal])
+    return np.nan_to_num(cost_matrix, copy=False, nan=1000)
 
 
 def cost_matrix_assign_3d(
         df: pd.DataFrame,
         rejection_cost_factor: float = 2,
-        exact: bool = False,
+        method: str = "greedy",
+        dtype: type = np.float64,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        deadline: float | None = None,
+        stats: dict | None = None,
     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Calculate the cost matrix and find optimal matching with 3D algorithm.
 
@@ -212,84 +1097,885 @@ def cost_matrix_assign_3d(
             1 = no extra cost for rejecting, more rejected cells, better N:P ratio of accepted cells
             10 = high cost to reject cells, fewer rejected cells, worse N:P ratio of accepted cells
             2 = compromise
-        exact (bool, optional): Use exact matching. Defaults to False.
+        method (str, optional): "greedy", "exact" or "lagrangian" matching. Defaults to "greedy".
+        dtype (type, optional): data type of the cost matrix. Defaults to np.float64.
+        initial (tuple, optional): anode, cathode and ratio indices of a known matching to warm
+            start from. The result is never worse than this matching.
+        deadline (float, optional): time.perf_counter() time to stop exact matching and return the
+            best matching found. Defaults to TIMEOUT_SECONDS from now.
+        stats (dict, optional): if given, the time to build the cost matrix is stored under
+            "Cost Matrix Seconds", and the lower bound of exact and Lagrangian matching under
+            "Lower Bound".
 
     Returns:
         tuple: The indices of the optimal matching of anodes and cathodes.
 
     """
-    n = len(df)
+    start_time = time.perf_counter()
+    cost_matrix = cost_matrix_3d(df, rejection_cost_factor, dtype=dtype)
+    if stats is not None:
+        stats["Cost Matrix Seconds"] = time.perf_counter() - start_time
+
+    # Find the optimal matching of anodes and cathodes
+    match method:
+        case "exact":
+            # Warm start from greedy matching, so the result is at least as good as greedy
+            greedy = greedy_npartite_matching(cost_matrix, improve_seconds=LOCAL_SEARCH_SECONDS)
+            if initial is not None:
+                initial = improve_npartite_matching(cost_matrix, *initial)
+                if cost_matrix[initial].sum() < cost_matrix[greedy].sum():
+                    greedy = initial
+            anode_ind, cathode_ind, ratio_ind, lower_bound = exact_npartite_matching(
+                cost_matrix, rejection_cost_factor, deadline=deadline, initial=greedy,
+            )
+        case "lagrangian":
+            anode_ind, cathode_ind, ratio_ind, lower_bound = lagrangian_npartite_matching(
+                cost_matrix, initial=initial,
+            )
+        case "greedy":
+            anode_ind, cathode_ind, ratio_ind = greedy_npartite_matching(
+                cost_matrix, improve_seconds=LOCAL_SEARCH_SECONDS,
+            )
+            lower_bound = None
+        case _:
+            msg = f"Unknown 3D matching method: {method}"
+            raise ValueError(msg)
+
+    # Keep the initial matching if it is better
+    if initial is not None:
+        initial = improve_npartite_matching(cost_matrix, *initial)
+        if cost_matrix[initial].sum() < cost_matrix[anode_ind, cathode_ind, ratio_ind].sum():
+            anode_ind, cathode_ind, ratio_ind = initial
+    if stats is not None and method != "greedy":
+        # None if exact matching stopped without a lower bound
+        stats["Lower Bound"] = None if lower_bound is None else float(lower_bound)
+
+    # Sort such that the anode doesn't change order
+    ind_sort=np.argsort(anode_ind)
+    return anode_ind[ind_sort], cathode_ind[ind_sort], ratio_ind[ind_sort]
 
-    # Convert all 1D arrays to 3D n x n x n arrays
-    anode_capacity = np.array(df["Anode Balancing Capacity (mAh)"]/df["Anode Diameter (mm)"]**2)
-    anode_capacity = np.tile(anode_capacity[:, np.newaxis, np.newaxis], (1, n, n))
-    cathode_capacity = np.array(df["Cathode Balancing Capacity (mAh)"]/df["Cathode Diameter (mm)"]**2)
-    cathode_capacity = np.tile(cathode_capacity[np.newaxis, :, np.newaxis], (n, 1, n))
-    target_ratio = np.array(df["Target N:P Ratio"])
-    target_ratio = np.tile(target_ratio[np.newaxis, np.newaxis, :], (n, n, 1))
-    min_ratio = np.array(df["Minimum N:P Ratio"])
-    min_ratio = np.tile(min_ratio[np.newaxis, np.newaxis, :], (n, n, 1))
-    max_ratio = np.array(df["Maximum N:P Ratio"])
-    max_ratio = np.tile(max_ratio[np.newaxis, np.newaxis, :], (n, n, 1))
-
-    # Calculate the 3D cost matrix
-    cost_matrix = anode_capacity/cathode_capacity - target_ratio
-
-    # If the cost diff is negative, divide by (min_ratio - target_ratio)
-    neg_mask = cost_matrix < 0
-    cost_matrix[neg_mask] = cost_matrix[neg_mask]/(min_ratio[neg_mask] - target_ratio[neg_mask])
-
-    # If the cost diff is positive, divide by (max_ratio - target_ratio)
-    pos_mask = cost_matrix > 0
-    cost_matrix[pos_mask] = cost_matrix[pos_mask]/(max_ratio[pos_mask] - target_ratio[pos_mask])
 
-    # If the normalised cost is over 1 the cell is rejected, so set the cost to the rejection_cost_factor
-    cost_matrix[cost_matrix > 1] = rejection_cost_factor
+def get_ratio_classes(df: pd.DataFrame) -> np.ndarray:
+    """Group the rows into classes with the same target, minimum and maximum N:P ratio.
 
-    # Set NaNs to a very large number, diagonal elements slightly less so unassigned electrodes are not moved
-    for i in range(n):
-        if np.isnan(cost_matrix[i, i, i]):
-            cost_matrix[i, i, i] = 999.999
-    cost_matrix = np.nan_to_num(cost_matrix, nan=1000)
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+
+    Returns:
+        numpy.ndarray: The ratio class of each row.
+
+    """
+    ratios = df[["Target N:P Ratio", "Minimum N:P Ratio", "Maximum N:P Ratio"]].to_numpy()
+    _, ratio_classes = np.unique(ratios, axis=0, return_inverse=True)
+    return ratio_classes.reshape(-1)
 
-    # Find the optimal matching of anodes and cathodes using greedy algorithm
-    if exact:
-        anode_ind, cathode_ind, ratio_ind = exact_npartite_matching(cost_matrix)
+
+def ratio_class_assign(
+        df: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        stats: dict | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the optimal matching with 3D cost function, grouping identical N:P ratios into classes.
+
+    Rows with the same target, minimum and maximum N:P ratio are interchangeable, so the cost matrix
+    only needs one column per ratio class (n x n x m instead of n x n x n). With one class this is
+    the 2D assignment of anodes to cathodes and is solved exactly with linear sum assignment. With
+    more classes, the class capacities are handled by Lagrangian relaxation, which returns the gap to
+    the optimal solution. Each anode-cathode pair is then given a ratio from its class.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        initial (tuple, optional): anode, cathode and ratio indices of a known matching to warm
+            start the Lagrangian relaxation from.
+        stats (dict, optional): if given, the time to build the cost matrix is stored under
+            "Cost Matrix Seconds" and the lower bound under "Lower Bound".
+
+    Returns:
+        tuple: The indices of the optimal matching of anodes, cathodes and ratios.
+
+    """
+    n = len(df)
+    ratio_classes = get_ratio_classes(df)
+    capacities = np.bincount(ratio_classes)
+    print(f"Grouped {n} N:P ratios into {len(capacities)} classes")
+    start_time = time.perf_counter()
+    cost_matrix = cost_matrix_3d(df, rejection_cost_factor, ratio_classes)
+    if stats is not None:
+        stats["Cost Matrix Seconds"] = time.perf_counter() - start_time
+
+    if len(capacities) == 1:
+        anode_ind, cathode_ind = linear_sum_assignment(cost_matrix[:, :, 0])
+        class_ind = np.zeros(n, dtype=int)
+        lower_bound = cost_matrix[anode_ind, cathode_ind, 0].sum()
     else:
-        anode_ind, cathode_ind, ratio_ind = greedy_npartite_matching(cost_matrix)
+        if initial is not None:
+            initial = (initial[0], initial[1], ratio_classes[initial[2]])
+        anode_ind, cathode_ind, class_ind, lower_bound = lagrangian_npartite_matching(
+            cost_matrix, capacities=capacities, initial=initial,
+        )
+    if stats is not None:
+        stats["Lower Bound"] = float(lower_bound)
+
+    # Give each pair a ratio from its class, keeping the ratio with its own anode where possible
+    ratio_ind = np.empty(n, dtype=int)
+    for ratio_class in range(len(capacities)):
+        pairs = np.where(class_ind == ratio_class)[0]
+        slots = np.where(ratio_classes == ratio_class)[0]
+        keep = np.isin(anode_ind[pairs], slots)
+        ratio_ind[pairs[keep]] = anode_ind[pairs[keep]]
+        ratio_ind[pairs[~keep]] = np.setdiff1d(slots, anode_ind[pairs[keep]])
 
     # Sort such that the anode doesn't change order
     ind_sort=np.argsort(anode_ind)
     return anode_ind[ind_sort], cathode_ind[ind_sort], ratio_ind[ind_sort]
 
 
-def rearrange_electrode_columns(
+def joint_ratio_class_assign(
+        df: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        stats: dict | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Reassign anodes and cathodes between rows, keeping the N:P ratio of each row in place.
+
+    The rows of a ratio class are interchangeable, so the matching of ratio_class_assign can also be
+    placed by moving each anode-cathode pair to the row of its ratio, rather than moving the ratio to
+    the row of the anode. The row keeps its N:P ratio, casing, separator and electrolyte. Anodes stay
+    in their own row where their class allows it.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        initial (tuple, optional): anode, cathode and ratio indices of a known matching to warm
+            start the Lagrangian relaxation from.
+        stats (dict, optional): passed to ratio_class_assign.
+
+    Returns:
+        tuple: The anode and cathode indices for each row, and the unchanged ratio indices.
+
+    """
+    anode_ind, cathode_ind, ratio_ind = ratio_class_assign(df, rejection_cost_factor, initial=initial, stats=stats)
+    row_sort = np.argsort(ratio_ind)
+    return anode_ind[row_sort], cathode_ind[row_sort], np.arange(len(df))
+
+
+def matching_cost(
         df: pd.DataFrame,
-        row_indices: np.ndarray,
         anode_ind: np.ndarray,
         cathode_ind: np.ndarray,
         ratio_ind: np.ndarray,
+        rejection_cost_factor: float = 2,
+    ) -> float:
+    """Calculate the total cost of a matching with the same cost function as cost_matrix_3d.
+
+    Only the n chosen triples are evaluated, so matchings from different methods can be compared
+    without building the n x n x n cost matrix.
+    """
+    anode_capacity = (df["Anode Balancing Capacity (mAh)"]/df["Anode Diameter (mm)"]**2).to_numpy()
+    cathode_capacity = (df["Cathode Balancing Capacity (mAh)"]/df["Cathode Diameter (mm)"]**2).to_numpy()
+    target_ratio = df["Target N:P Ratio"].to_numpy()[ratio_ind]
+    deviation = anode_capacity[anode_ind] / cathode_capacity[cathode_ind] - target_ratio
+    with np.errstate(invalid="ignore"):
+        cost = np.where(
+            deviation < 0,
+            deviation / (df["Minimum N:P Ratio"].to_numpy()[ratio_ind] - target_ratio),
+            deviation / (df["Maximum N:P Ratio"].to_numpy()[ratio_ind] - target_ratio),
+        )
+        cost[cost > 1] = rejection_cost_factor
+    return float(np.nan_to_num(cost, nan=1000).sum())
+
+
+def portfolio_solver(
+        solver: str,
+        df_batch: pd.DataFrame,
+        rejection_cost_factor: float,
+        wall_deadline: float,
+        results: multiprocessing.Queue,
+    ) -> None:
+    """Run one solver of the portfolio in a worker process and put its matching on the results queue.
+
+    The result is (solver, matching, optimal), where optimal is True if the matching is proven to be
+    optimal: ratio class matching with one class, or exact matching with no gap. The deadline is a
+    time.time(), as time.perf_counter() cannot be compared between processes.
+
+    On POSIX the worker leads its own process group, so that terminate_process_tree also stops the
+    CBC subprocess of exact matching.
+    """
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    deadline = time.perf_counter() + max(wall_deadline - time.time(), 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        match solver:
+            case "greedy":
+                matching = cost_matrix_assign_3d(df_batch, rejection_cost_factor)
+                optimal = False
+            case "ratio class":
+                matching = ratio_class_assign(df_batch, rejection_cost_factor)
+                optimal = get_ratio_classes(df_batch).max() == 0
+            case "exact":
+                cost_matrix = cost_matrix_3d(df_batch, rejection_cost_factor)
+                *matching, lower_bound = exact_npartite_matching(
+                    cost_matrix, rejection_cost_factor, deadline=deadline,
+                    initial=greedy_npartite_matching(cost_matrix),
+                )
+                optimal = lower_bound is not None and cost_matrix[tuple(matching)].sum() - lower_bound < 1e-6
+            case _:
+                msg = f"Unknown portfolio solver: {solver}"
+                raise ValueError(msg)
+    results.put((solver, tuple(np.asarray(ind) for ind in matching), optimal))
+
+
+def terminate_process_tree(process: multiprocessing.Process) -> None:
+    """Terminate a portfolio worker process together with its child processes.
+
+    process.terminate() only stops the worker itself, and the CBC subprocess started by PuLP for
+    exact matching would keep using a CPU until its own time limit.
+    """
+    if sys.platform == "win32":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True, check=False)
+    else:
+        with contextlib.suppress(ProcessLookupError):  # worker has not called setpgrp yet
+            os.killpg(process.pid, signal.SIGTERM)
+    process.terminate()
+
+
+def portfolio_assign(
+        df_batch: pd.DataFrame,
+        rejection_cost_factor: float = 2,
+        deadline: float | None = None,
+        solvers: list[str] = PORTFOLIO_SOLVERS,
+        stats: dict | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Race several solvers in parallel processes and use the best matching.
+
+    Each solver runs in its own process. As soon as one returns a matching that is proven to be
+    optimal it is used and the other processes are terminated, including the CBC subprocess of
+    exact matching. Otherwise, the matching with the lowest cost found before the deadline is used.
+    If no solver has finished at the deadline, the first one to finish is used.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        deadline (float, optional): time.perf_counter() time to stop waiting for better matchings.
+            Defaults to TIMEOUT_SECONDS from now.
+        solvers (list[str], optional): solvers to race. Defaults to PORTFOLIO_SOLVERS.
+        stats (dict, optional): if given and the matching is proven optimal, its cost is stored
+            under "Lower Bound".
+
+    Returns:
+        tuple: The anode, cathode and ratio indices of the best matching.
+
+    """
+    timeout = TIMEOUT_SECONDS if deadline is None else max(deadline - time.perf_counter(), 0)
+    deadline = time.perf_counter() + timeout
+    print(f"Racing {', '.join(solvers)} matching for up to {timeout:.1f} seconds")
+    wall_deadline = time.time() + timeout
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=portfolio_solver, args=(solver, df_batch, rejection_cost_factor, wall_deadline, results),
+        )
+        for solver in solvers
+    ]
+    for process in processes:
+        process.start()
+
+    start_time = time.perf_counter()
+    best_matching, best_cost, best_solver, best_optimal = None, np.inf, None, False
+    n_finished = 0
+    try:
+        while n_finished < len(processes):
+            try:
+                solver, matching, optimal = results.get(timeout=0.1)
+            except queue.Empty:
+                if best_matching is not None and time.perf_counter() > deadline:
+                    break
+                if not any(process.is_alive() for process in processes) and results.empty():
+                    break
+                continue
+            n_finished += 1
+            cost = matching_cost(df_batch, *matching, rejection_cost_factor)
+            print(f"{solver} matching finished after {time.perf_counter() - start_time:.2f} seconds "
+                  f"with cost {cost:.4f}{', proven optimal' if optimal else ''}")
+            if cost < best_cost:
+                best_matching, best_cost, best_solver, best_optimal = matching, cost, solver, optimal
+            if optimal:
+                break
+    finally:
+        for process in processes:
+            if process.is_alive():
+                terminate_process_tree(process)
+            process.join()
+
+    if best_matching is None:
+        msg = "No portfolio solver returned a matching"
+        raise ValueError(msg)
+    print(f"Using {best_solver} matching with cost {best_cost:.4f}")
+    if stats is not None and best_optimal:
+        stats["Lower Bound"] = best_cost
+    return best_matching
+
+
+def get_batch_features(df_batch: pd.DataFrame, sample_size: int = 2000, seed: int = 0) -> dict[str, float]:
+    """Calculate the features of a batch used to predict the solve time of each sorting method.
+
+    The infeasible fraction is estimated from a random sample of anode-cathode pairs, and is the
+    fraction of pairs and ratio classes where the N:P ratio is outside the limits.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        sample_size (int, optional): number of anode-cathode pairs to sample. Defaults to 2000.
+        seed (int, optional): random seed for the sample. Defaults to 0.
+
+    Returns:
+        dict: The number of cells, number of ratio classes and infeasible fraction.
+
+    """
+    n = len(df_batch)
+    _, ratio_rows = np.unique(get_ratio_classes(df_batch), return_index=True)
+    anode_capacity = (df_batch["Anode Balancing Capacity (mAh)"]/df_batch["Anode Diameter (mm)"]**2).to_numpy()
+    cathode_capacity = (
+        df_batch["Cathode Balancing Capacity (mAh)"]/df_batch["Cathode Diameter (mm)"]**2
+    ).to_numpy()
+    pairs = np.random.default_rng(seed).integers(n, size=(min(sample_size, n * n), 2))
+    actual_ratio = (anode_capacity[pairs[:, 0]] / cathode_capacity[pairs[:, 1]])[:, np.newaxis]
+    feasible = (
+        (actual_ratio >= df_batch["Minimum N:P Ratio"].to_numpy()[ratio_rows])
+        & (actual_ratio <= df_batch["Maximum N:P Ratio"].to_numpy()[ratio_rows])
+    )
+    return {"n": n, "ratio_classes": len(ratio_rows), "infeasible_fraction": 1 - float(feasible.mean())}
+
+
+def solve_time_features(features: dict[str, float]) -> np.ndarray:
+    """Get the regressors of the log-linear solve time model from the batch features."""
+    return np.array([
+        1,
+        np.log(features["n"]),
+        np.log(features["ratio_classes"]),
+        features["infeasible_fraction"],
+    ])
+
+
+def load_solve_time_model(filepath: Path = SOLVE_TIME_MODEL_FILEPATH) -> dict[int, np.ndarray] | None:
+    """Load the solve time model coefficients of each sorting method, None if not calibrated.
+
+    The model is calibrated with `py benchmark.py --calibrate`.
+    """
+    if not filepath.exists():
+        return None
+    model = json.loads(filepath.read_text())
+    return {int(method): np.array(coefficients) for method, coefficients in model["coefficients"].items()}
+
+
+def predict_solve_times(features: dict[str, float], model: dict[int, np.ndarray]) -> dict[int, float]:
+    """Predict the solve time in seconds of each sorting method in the model."""
+    x = solve_time_features(features)
+    return {method: float(np.exp(x @ coefficients)) for method, coefficients in model.items()}
+
+
+def choose_sorting_method(
+        df_batch: pd.DataFrame,
+        latency_budget: float = LATENCY_BUDGET_SECONDS,
+        model: dict[int, np.ndarray] | None = None,
+    ) -> tuple[int, float | None]:
+    """Choose the sorting method for a batch when using automatic selection (sorting method 6).
+
+    If all N:P ratios are the same, 2D matching (method 3) is optimal and fast. Otherwise, exact 3D
+    matching (method 5) is optimal, and is used if its predicted solve time is within the latency
+    budget. If not, use ratio class matching (method 8) if some ratios are the same, or Lagrangian
+    relaxation (method 7) if not, which both stop after LAGRANGIAN_TIMEOUT_SECONDS. Without a
+    calibrated model, exact matching is never chosen.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        latency_budget (float, optional): time in seconds the solve should take. Defaults to
+            LATENCY_BUDGET_SECONDS.
+        model (dict, optional): solve time model coefficients of each sorting method.
+
+    Returns:
+        tuple: The chosen sorting method, and its predicted solve time if there is a model.
+
+    """
+    features = get_batch_features(df_batch)
+    predictions = predict_solve_times(features, model) if model is not None else {}
+    if features["ratio_classes"] == 1:
+        method = 3
+    elif 5 in predictions and predictions[5] <= latency_budget:
+        method = 5
+    elif features["ratio_classes"] < features["n"]:
+        method = 8
+    else:
+        method = 7
+    return method, predictions.get(method)
+
+
+def solve_batch(
+        df_batch: pd.DataFrame,
+        sorting_method: int,
+        rejection_cost_factor: float = 2,
+        initial: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None,
+        deadline: float | None = None,
+        latency_budget: float = LATENCY_BUDGET_SECONDS,
+        stats: dict | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the anode, cathode and ratio order for one batch with the given sorting method.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        sorting_method (int): The sorting method, see the module docstring.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        initial (tuple, optional): anode, cathode and ratio indices of a previous solution to warm
+            start the 3D methods from.
+        deadline (float, optional): time.perf_counter() time to stop exact 3D matching.
+        latency_budget (float, optional): time in seconds a batch should take when choosing the
+            method automatically. Defaults to LATENCY_BUDGET_SECONDS.
+        stats (dict, optional): if given, the sorting method used, solve status, cost of the matching
+            with the 3D cost function, lower bound and gap where known, time to build the cost
+            matrix and total time are stored in it.
+
+    Returns:
+        tuple: The anode, cathode and ratio indices for the batch.
+
+    """
+    start_time = time.perf_counter()
+    n_rows = len(df_batch)
+    match sorting_method:
+        case 0 | 1: # Do not sort
+            anode_ind = np.arange(n_rows)
+            cathode_ind = np.arange(n_rows)
+            ratio_ind = np.arange(n_rows)
+
+        case 2: # Order by capacity
+            # I think this is always worse than the cost matrix approach
+            anode_sort = np.argsort(df_batch["Anode Balancing Capacity (mAh)"].to_numpy())
+            cathode_sort = np.argsort(df_batch["Cathode Balancing Capacity (mAh)"].to_numpy())
+            # Ensure that anode positions do not change
+            anode_ind = np.arange(n_rows)
+            cathode_ind = cathode_sort[np.argsort(anode_sort)]
+            ratio_ind = np.arange(n_rows)
+
+        case 3: # Use cost matrix and linear sum assignment
+            anode_ind, cathode_ind = cost_matrix_assign(df_batch, rejection_cost_factor, stats=stats)
+            ratio_ind = np.arange(n_rows)
+
+        case 4: # Use greedy 3D matching
+            anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(
+                df_batch, rejection_cost_factor, initial=initial, stats=stats,
+            )
+
+        case 5: # Use exact 3D matching, stopping at the deadline with the best matching found
+            anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(
+                df_batch, rejection_cost_factor, method="exact", initial=initial, deadline=deadline,
+                stats=stats,
+            )
+
+        case 6: # Choose automatically from the predicted solve time of each method
+            method, predicted_time = choose_sorting_method(df_batch, latency_budget, load_solve_time_model())
+            budget_deadline = time.perf_counter() + latency_budget
+            method_start_time = time.perf_counter()
+            anode_ind, cathode_ind, ratio_ind = solve_batch(
+                df_batch, method, rejection_cost_factor, initial=initial,
+                deadline=budget_deadline if deadline is None else min(deadline, budget_deadline),
+                stats=stats,
+            )
+            solve_time = time.perf_counter() - method_start_time
+            if predicted_time is None:
+                print(f"Automatically chose sorting method {method}, took {solve_time:.2f} seconds")
+            else:
+                print(f"Automatically chose sorting method {method}, predicted {predicted_time:.2f} seconds, "
+                      f"took {solve_time:.2f} seconds")
+
+        case 7: # Use Lagrangian relaxation 3D matching
+            anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(
+                df_batch, rejection_cost_factor, method="lagrangian", initial=initial, stats=stats,
+            )
+
+        case 8: # Use ratio class matching
+            anode_ind, cathode_ind, ratio_ind = ratio_class_assign(
+                df_batch, rejection_cost_factor, initial=initial, stats=stats,
+            )
+
+        case 9: # Race greedy, ratio class and exact matching
+            anode_ind, cathode_ind, ratio_ind = portfolio_assign(
+                df_batch, rejection_cost_factor, deadline=deadline, stats=stats,
+            )
+
+        case 10: # Use sparse 2D matching
+            anode_ind, cathode_ind = sparse_cost_matrix_assign(df_batch, rejection_cost_factor)
+            ratio_ind = np.arange(n_rows)
+
+        case 11: # Use joint anode and cathode reassignment, keeping the ratios in place
+            anode_ind, cathode_ind, ratio_ind = joint_ratio_class_assign(
+                df_batch, rejection_cost_factor, initial=initial, stats=stats,
+            )
+
+        case _:
+            msg = f"Unknown sorting method: {sorting_method}"
+            raise ValueError(msg)
+
+    # Method 6 records the stats of the method it chose, apart from the total time
+    if stats is not None and sorting_method != 6:
+        stats["Sorting Method"] = sorting_method
+        stats["Cost"] = matching_cost(df_batch, anode_ind, cathode_ind, ratio_ind, rejection_cost_factor)
+        if "Lower Bound" in stats and stats["Lower Bound"] is None:
+            # Stopped before the solver proved a lower bound, the gap is unknown
+            stats["Status"] = "feasible"
+        elif "Lower Bound" in stats:
+            stats["Gap"] = max(stats["Cost"] - stats["Lower Bound"], 0)
+            stats["Status"] = "optimal" if stats["Gap"] <= 1e-6 * max(1, abs(stats["Cost"])) else "feasible"
+        elif sorting_method in (0, 1):
+            stats["Status"] = "unsorted"
+        elif sorting_method == 3:
+            stats["Status"] = "optimal"
+        else:
+            stats["Status"] = "heuristic"
+    if stats is not None:
+        stats["Seconds"] = time.perf_counter() - start_time
+
+    return np.asarray(anode_ind), np.asarray(cathode_ind), np.asarray(ratio_ind)
+
+
+def evaluate_matching(
+        df_batch: pd.DataFrame,
+        anode_ind: np.ndarray,
+        cathode_ind: np.ndarray,
+        ratio_ind: np.ndarray,
+    ) -> tuple[int, float]:
+    """Calculate the number of accepted cells and their mean N:P deviation for a batch matching.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        anode_ind (numpy.ndarray): Anode indices for the matching.
+        cathode_ind (numpy.ndarray): Cathode indices for the matching.
+        ratio_ind (numpy.ndarray): Ratio indices for the matching.
+
+    Returns:
+        tuple: The number of accepted cells and the mean absolute deviation from the target N:P ratio.
+
+    """
+    anode_capacity = (df_batch["Anode Balancing Capacity (mAh)"]/df_batch["Anode Diameter (mm)"]**2).to_numpy()
+    cathode_capacity = (
+        df_batch["Cathode Balancing Capacity (mAh)"]/df_batch["Cathode Diameter (mm)"]**2
+    ).to_numpy()
+    actual_ratio = anode_capacity[anode_ind] / cathode_capacity[cathode_ind]
+    target_ratio = df_batch["Target N:P Ratio"].to_numpy()[ratio_ind]
+    accepted = (
+        (actual_ratio >= df_batch["Minimum N:P Ratio"].to_numpy()[ratio_ind])
+        & (actual_ratio <= df_batch["Maximum N:P Ratio"].to_numpy()[ratio_ind])
+    )
+    mean_deviation = np.abs(actual_ratio[accepted] - target_ratio[accepted]).mean() if accepted.any() else np.nan
+    return int(accepted.sum()), float(mean_deviation)
+
+
+def sweep_batch(
+        df_batch: pd.DataFrame,
+        sorting_method: int,
+        rejection_cost_factors: list[float],
+    ) -> list[tuple[float, int, float]]:
+    """Solve one batch for each rejection_cost_factor, warm starting from the previous solution.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        sorting_method (int): The sorting method, see the module docstring.
+        rejection_cost_factors (list[float]): The rejection cost factors to solve for.
+
+    Returns:
+        list: The rejection cost factor, accepted cells and mean N:P deviation of each solution.
+
+    """
+    results = []
+    solution = None
+    for rejection_cost_factor in rejection_cost_factors:
+        solution = solve_batch(df_batch, sorting_method, rejection_cost_factor, initial=solution)
+        results.append((rejection_cost_factor, *evaluate_matching(df_batch, *solution)))
+    return results
+
+
+def sweep_rejection_cost_factors(
+        df: pd.DataFrame,
+        batches: list[tuple[float, np.ndarray]],
+        sorting_method: int,
+        rejection_cost_factors: list[float],
+        workers: int | None = None,
+    ) -> pd.DataFrame:
+    """Solve all batches for a grid of rejection_cost_factors in parallel worker processes.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        batches (list): The batch number and row indices of each batch.
+        sorting_method (int): The sorting method, see the module docstring.
+        rejection_cost_factors (list[float]): The rejection cost factors to solve for.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        pandas.DataFrame: The accepted cell count and mean N:P deviation for each batch and factor.
+
+    """
+    rejection_cost_factors = sorted(rejection_cost_factors)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(sweep_batch, df.iloc[row_indices], sorting_method, rejection_cost_factors)
+            for _batch_number, row_indices in batches
+        ]
+        rows = [
+            (batch_number, *result)
+            for (batch_number, _row_indices), future in zip(batches, futures)
+            for result in future.result()
+        ]
+    df_options = pd.DataFrame(
+        rows, columns=["Batch Number", "Rejection Cost Factor", "Accepted Cells", "Mean N:P Deviation"],
+    )
+    df_options["Sorting Method"] = sorting_method
+    print("Balancing options:")
+    print(df_options.to_string(index=False))
+    return df_options
+
+
+def solve_batch_until(
+        df_batch: pd.DataFrame,
+        sorting_method: int,
+        rejection_cost_factor: float,
+        wall_deadline: float,
+        latency_budget: float = LATENCY_BUDGET_SECONDS,
+    ) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray], dict]:
+    """Solve one batch in a worker process, stopping exact 3D matching at a wall clock deadline.
+
+    time.perf_counter() cannot be compared between processes, so the deadline is a time.time(). The
+    time left is taken when the batch starts, with at least MIN_BATCH_TIMEOUT_SECONDS, so a batch that
+    waited for a free worker is not stopped at once. Returns the solution and the stats from solve_batch.
+    """
+    deadline = time.perf_counter() + max(wall_deadline - time.time(), MIN_BATCH_TIMEOUT_SECONDS)
+    stats = {}
+    solution = solve_batch(
+        df_batch, sorting_method, rejection_cost_factor, deadline=deadline, latency_budget=latency_budget,
+        stats=stats,
+    )
+    return solution, stats
+
+
+def solve_batches_parallel(
+        df: pd.DataFrame,
+        batches: list[tuple[float, np.ndarray]],
+        sorting_method: int,
+        rejection_cost_factor: float = 2,
+        timeout: float = TIMEOUT_SECONDS,
+        latency_budget: float = LATENCY_BUDGET_SECONDS,
+        workers: int | None = None,
+        batch_stats: list[dict] | None = None,
+    ) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Solve all batches at the same time in worker processes, with one deadline for all of them.
+
+    Batches waiting for a free worker still get at least MIN_BATCH_TIMEOUT_SECONDS once they start,
+    as in the sequential loop.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+        batches (list): The batch number and row indices of each batch.
+        sorting_method (int): The sorting method, see the module docstring.
+        rejection_cost_factor (float, optional): cost of rejected cells. Defaults to 2.
+        timeout (float, optional): time in seconds until exact 3D matching stops in every batch, or
+            MIN_BATCH_TIMEOUT_SECONDS after a batch starts if that is later. Defaults to TIMEOUT_SECONDS.
+        latency_budget (float, optional): time in seconds a batch should take when choosing the
+            method automatically. Defaults to LATENCY_BUDGET_SECONDS.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        batch_stats (list[dict], optional): if given, the stats from solve_batch of each batch are
+            appended to it, in the same order as batches.
+
+    Returns:
+        list: The anode, cathode and ratio indices of each batch, in the same order as batches.
+
+    """
+    if not batches:
+        return []
+    wall_deadline = time.time() + timeout
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                solve_batch_until, df.iloc[row_indices], sorting_method, rejection_cost_factor,
+                wall_deadline, latency_budget,
+            )
+            for _batch_number, row_indices in batches
+        ]
+        solutions = []
+        for future in futures:
+            solution, stats = future.result()
+            solutions.append(solution)
+            if batch_stats is not None:
+                batch_stats.append(stats)
+    print(f"Solved {len(batches)} batches in parallel in {time.perf_counter() - start_time:.2f} seconds")
+    return solutions
+
+
+def get_batches(df: pd.DataFrame) -> list[tuple[float, np.ndarray]]:
+    """Find the rows of each batch that are available for balancing.
+
+    Args:
+        df (pandas.DataFrame): The dataframe containing the cell assembly data.
+
+    Returns:
+        list: The batch number and row indices of each batch with available cells.
+
+    """
+    batches = []
+    batch_numbers = df["Batch Number"].unique()
+    batch_numbers = batch_numbers[~np.isnan(batch_numbers)]
+    for batch_number in batch_numbers:
+        # The step and error code are nullable integers, a missing value gives NA and the cell is skipped
+        batch_mask = (
+            (df["Batch Number"] == batch_number) &
+            (df["Last Completed Step"] == 0) &
+            (df["Error Code"] == 0) &
+            (df["Anode Balancing Capacity (mAh)"] > 0) &
+            (df["Cathode Balancing Capacity (mAh)"] > 0)
+        ).fillna(False)
+        # if no cells in this batch, skip
+        if not batch_mask.any():
+            print(f"Skipping batch number {batch_number} as there are no available cells.")
+            continue
+        row_indices = np.where(batch_mask)[0]
+        n_rows = len(row_indices)
+        n_rows_skipped = sum(df["Batch Number"] == batch_number) - n_rows
+        print(f"Batch number {batch_number} has {n_rows} cells.")
+        if n_rows_skipped:
+            print(f"Ignoring {n_rows_skipped} cells that do not have "
+                  f"Last Completed Step = 0 and Error Code = 0.")
+        batches.append((batch_number, row_indices))
+    return batches
+
+
+def batch_fingerprint(
+        df_batch: pd.DataFrame,
+        sorting_method: int,
+        rejection_cost_factor: float,
+        latency_budget: float = LATENCY_BUDGET_SECONDS,
+    ) -> str:
+    """Hash the values that determine the solution of a batch.
+
+    Args:
+        df_batch (pandas.DataFrame): The cell assembly data of the cells in the batch.
+        sorting_method (int): The sorting method.
+        rejection_cost_factor (float): cost of rejected cells.
+        latency_budget (float, optional): time in seconds a batch should take, only hashed for method
+            6 as it chooses the method from it. Defaults to LATENCY_BUDGET_SECONDS.
+
+    Returns:
+        str: The hex digest of the electrode and ratio columns, method, rejection cost factor and
+            latency budget.
+
+    """
+    key = [len(df_batch), sorting_method, rejection_cost_factor]
+    if sorting_method == 6:
+        key.append(latency_budget)
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps(key).encode())
+    fingerprint.update(df_batch[FINGERPRINT_COLUMNS].to_numpy(dtype=np.float64).tobytes())
+    return fingerprint.hexdigest()
+
+
+def create_cache_table(conn: sqlite3.Connection) -> None:
+    """Create the Balancing_Cache_Table if it does not exist."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS Balancing_Cache_Table ("
+        '"Fingerprint" TEXT PRIMARY KEY, "Anode Order" TEXT, "Cathode Order" TEXT, '
+        '"Ratio Order" TEXT, "Last Used" REAL)',
+    )
+
+
+def read_cached_solution(
+        conn: sqlite3.Connection,
+        fingerprint: str,
+        n: int,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+    """Look up the stored solution of a batch.
+
+    This only reads, so no write lock is held while the other batches are solved. The "Last Used"
+    time of the entry is updated with the new entries in write_cached_solutions.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        fingerprint (str): The batch fingerprint from batch_fingerprint.
+        n (int): The number of cells in the batch.
+
+    Returns:
+        tuple or None: The anode, cathode and ratio indices, or None if the batch is not cached.
+
+    """
+    row = conn.execute(
+        'SELECT "Anode Order", "Cathode Order", "Ratio Order" FROM Balancing_Cache_Table '
+        'WHERE "Fingerprint" = ?',
+        (fingerprint,),
+    ).fetchone()
+    if row is None:
+        return None
+    solution = tuple(np.array(json.loads(order), dtype=int) for order in row)
+    if any(len(ind) != n for ind in solution):
+        return None
+    return solution
+
+
+def write_cached_solutions(
+        conn: sqlite3.Connection,
+        solutions: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]],
+        cache_size: int = CACHE_SIZE,
+    ) -> None:
+    """Store batch solutions by fingerprint, keeping only the most recently used entries.
+
+    The solutions of all batches are written, including the ones read from the cache, so this also
+    marks the cache hits as recently used. Everything is written in one write transaction.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        solutions (dict): The anode, cathode and ratio indices of each batch fingerprint.
+        cache_size (int, optional): Number of entries to keep. Defaults to CACHE_SIZE.
+
+    """
+    now = time.time()
+    with write_transaction(conn):
+        conn.executemany(
+            'INSERT OR REPLACE INTO Balancing_Cache_Table VALUES (?, ?, ?, ?, ?)',
+            [
+                (fingerprint, *(json.dumps(np.asarray(ind).tolist()) for ind in solution), now)
+                for fingerprint, solution in solutions.items()
+            ],
+        )
+        conn.execute(
+            'DELETE FROM Balancing_Cache_Table WHERE "Fingerprint" NOT IN ('
+            'SELECT "Fingerprint" FROM Balancing_Cache_Table ORDER BY "Last Used" DESC LIMIT ?)',
+            (cache_size,),
+        )
+
+
+def rearrange_electrode_columns(
+        df: pd.DataFrame,
+        anode_perm: np.ndarray,
+        cathode_perm: np.ndarray,
+        ratio_perm: np.ndarray,
     ) -> None:
     """Rearrange eletrode columns in-place in the main dataframe.
 
+    Each permutation covers every row of the dataframe, row i takes its anode, cathode or ratio
+    columns from row perm[i]. The permutations are built for all batches first, then applied to
+    each group of columns in one pass.
+
     Args:
         df (pandas.DataFrame): The dataframe containing the cell assembly data.
-        row_indices (numpy.ndarray): The indices for the rows in df being rearranged.
-        anode_ind (numpy.ndarray): Anode indices for optimal matching.
-        cathode_ind (numpy.ndarray): Cathode indices for optimal matching.
-        ratio_ind (numpy.ndarray): Ratio indices for optimal matching.
+        anode_perm (numpy.ndarray): Row permutation for the anode columns.
+        cathode_perm (numpy.ndarray): Row permutation for the cathode columns.
+        ratio_perm (numpy.ndarray): Row permutation for the ratio columns.
 
     """
     anode_columns = [col for col in df.columns if "Anode" in col]
     cathode_columns = [col for col in df.columns if "Cathode" in col]
     ratio_columns = ["Target N:P Ratio", "Minimum N:P Ratio", "Maximum N:P Ratio"]
-    df_immutable = df.copy()
-    for column in anode_columns:
-        df.loc[row_indices, column] = df_immutable.loc[row_indices[anode_ind], column].to_numpy()
-    for column in cathode_columns:
-        df.loc[row_indices, column] = df_immutable.loc[row_indices[cathode_ind], column].to_numpy()
-    for column in ratio_columns:
-        df.loc[row_indices, column] = df_immutable.loc[row_indices[ratio_ind], column].to_numpy()
+    for columns, perm in (
+        (anode_columns, anode_perm),
+        (cathode_columns, cathode_perm),
+        (ratio_columns, ratio_perm),
+    ):
+        df[columns] = df[columns].take(perm).set_axis(df.index)
     # Recalculate N:P ratio overlap factor
     df["N:P ratio overlap factor"] = (df["Cathode Diameter (mm)"]**2 / df["Anode Diameter (mm)"]**2).fillna(0)
 
@@ -307,28 +1993,73 @@ def update_cell_numbers(df: pd.DataFrame, base_sample_id: str, check_NP_ratio: b
             (df["Anode Balancing Capacity (mAh)"] / df["Anode Diameter (mm)"]**2) /
             (df["Cathode Balancing Capacity (mAh)"] / df["Cathode Diameter (mm)"]**2)
         )
-        cell_meets_criteria = ((df["Actual N:P Ratio"] >= df["Minimum N:P Ratio"])
-                                & (df["Actual N:P Ratio"] <= df["Maximum N:P Ratio"]))
-        accepted_cell_indices = np.where(cell_meets_criteria)[0]
-        rejected_cell_indices = np.where(~cell_meets_criteria & ~df["Actual N:P Ratio"].isna())[0]
-        average_deviation = np.mean(np.abs(df["Actual N:P Ratio"][accepted_cell_indices]
-                                        - df["Target N:P Ratio"][accepted_cell_indices]))
-        print(f"Accepted {len(accepted_cell_indices)} cells "
+        accepted = ((df["Actual N:P Ratio"] >= df["Minimum N:P Ratio"])
+                    & (df["Actual N:P Ratio"] <= df["Maximum N:P Ratio"])).to_numpy()
+        rejected = ~accepted & df["Actual N:P Ratio"].notna().to_numpy()
+        average_deviation = np.mean(np.abs(df["Actual N:P Ratio"][accepted]
+                                        - df["Target N:P Ratio"][accepted]))
+        print(f"Accepted {accepted.sum()} cells "
             f"with average N:P deviation from target: {average_deviation:.4f}\n"
-            f"Rejected {len(rejected_cell_indices)} cells.")
+            f"Rejected {rejected.sum()} cells.")
     else:
         # accept any cell with an anode and cathode
-        accepted_cell_indices = np.where(
-            ~df["Anode Type"].isna() &
-            ~df["Cathode Type"].isna(),
-        )[0]
-        print(f"Accepted {len(accepted_cell_indices)} cells without checking N:P ratio.")
+        accepted = (df["Anode Type"].notna() & df["Cathode Type"].notna()).to_numpy()
+        print(f"Accepted {accepted.sum()} cells without checking N:P ratio.")
 
     # Re-write the Cell Number column to only include cells with both anode and cathode
-    df["Cell Number"] = 0
-    for cell_number, cell_index in enumerate(accepted_cell_indices):
-        df.loc[cell_index, "Cell Number"] = cell_number + 1
-        df.loc[cell_index, "Sample ID"] = f"{base_sample_id}_{cell_number + 1:02d}"
+    cell_numbers = np.cumsum(accepted) * accepted
+    df["Cell Number"] = cell_numbers
+    df.loc[accepted, "Sample ID"] = [f"{base_sample_id}_{cell_number:02d}" for cell_number in cell_numbers[accepted]]
+
+
+@contextlib.contextmanager
+def timed_phase(timings: list[dict], phase: str) -> Iterator[None]:
+    """Time the code in a with block and append the phase and seconds to timings."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append({"Phase": phase, "Seconds": time.perf_counter() - start_time})
+
+
+def performance_log(
+        timings: list[dict],
+        run_start: str,
+        sorting_method: int,
+        rejection_cost_factor: float,
+    ) -> pd.DataFrame:
+    """Collect the phase and batch timings of a run into the Performance_Log format.
+
+    Args:
+        timings (list[dict]): Phase, seconds and, for batches, the stats from solve_batch.
+        run_start (str): Time the run started, in ISO format.
+        sorting_method (int): The sorting method requested, batches store the method used.
+        rejection_cost_factor (float): cost of rejected cells.
+
+    Returns:
+        pandas.DataFrame: One row per phase and batch with the PERFORMANCE_LOG_DTYPES columns.
+
+    """
+    df_performance = pd.DataFrame(timings).reindex(columns=list(PERFORMANCE_LOG_DTYPES))
+    df_performance["Run Start"] = run_start
+    df_performance["Sorting Method"] = df_performance["Sorting Method"].fillna(sorting_method)
+    df_performance["Rejection Cost Factor"] = rejection_cost_factor
+    return df_performance
+
+
+def print_performance_summary(df_performance: pd.DataFrame) -> None:
+    """Print the time of each phase, and the size, method, status and gap of each batch."""
+    print("Performance summary:")
+    for row in df_performance.to_dict("records"):
+        if row["Phase"] == "Solve batch":
+            details = [f"n={row['Cells']:.0f}", f"method {row['Sorting Method']:.0f}", row["Status"]]
+            if pd.notna(row["Gap"]):
+                details.append(f"gap {row['Gap']:.4f}")
+            if pd.notna(row["Cost Matrix Seconds"]):
+                details.append(f"cost matrix {row['Cost Matrix Seconds']:.3f} s")
+            print(f"  {'Batch ' + str(row['Batch Number']):<24}{row['Seconds']:8.3f} s  ({', '.join(details)})")
+        else:
+            print(f"  {row['Phase']:<24}{row['Seconds']:8.3f} s")
 
 
 def main() -> None:
@@ -338,108 +2069,204 @@ def main() -> None:
     cathodes, and match the cathodes with the anodes to achieve the desired N:P ratio. Write the
     updated table back to the database.
     """
-    sorting_method = int(sys.argv[1]) if len(sys.argv) >= 2 else 6
+    parser = argparse.ArgumentParser(description="Match cathodes with anodes to achieve the desired N:P ratio.")
+    parser.add_argument("sorting_method", type=int, nargs="?", default=6)
+    parser.add_argument("rejection_cost_factor", type=float, nargs="?", default=2)
+    parser.add_argument("--sweep", type=float, nargs="*", metavar="FACTOR")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--parallel", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--budget", type=float, default=LATENCY_BUDGET_SECONDS)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+    sorting_method = args.sorting_method
+    rejection_cost_factor = args.rejection_cost_factor
 
     print(f"Reading from database {DATABASE_FILEPATH}")
-    print(f"Using sorting method {sorting_method}")
+    print(f"Using sorting method {sorting_method} with rejection cost factor {rejection_cost_factor}")
+
+    # Time of each phase and batch, printed at the end and appended to the Performance_Log table
+    run_start = datetime.now().isoformat(timespec="seconds")
+    run_start_time = time.perf_counter()
+    timings = []
 
     # Connect to the database and create the Cell_Assembly_Table
-    with sqlite3.connect(DATABASE_FILEPATH) as conn:
+    with connect(DATABASE_FILEPATH) as conn:
         # Read from database and calculate capacity
-        df = pd.read_sql("SELECT * FROM Cell_Assembly_Table", conn)
-        calculate_capacity(df)
-
-        # Split the dataframe into sub-dataframes for each batch number
-        batch_numbers = df["Batch Number"].unique()
-        batch_numbers = batch_numbers[~np.isnan(batch_numbers)]
-
-        for batch_number in batch_numbers:
-            batch_mask = (
-                (df["Batch Number"] == batch_number) &
-                (df["Last Completed Step"] == 0) &
-                (df["Error Code"] == 0) &
-                (df["Anode Balancing Capacity (mAh)"] > 0) &
-                (df["Cathode Balancing Capacity (mAh)"] > 0)
+        with timed_phase(timings, "Read table"):
+            columns = [
+                column for column in table_columns(conn, "Cell_Assembly_Table")
+                if column in CELL_ASSEMBLY_COLUMNS or "Anode" in column or "Cathode" in column
+            ]
+            df = read_table(conn, "Cell_Assembly_Table", columns)
+            df_original = df.copy()
+        with timed_phase(timings, "Calculate capacity"):
+            calculate_capacity(df)
+
+        # Split the dataframe into batches
+        batches = get_batches(df)
+
+        # Solve every batch for a range of rejection cost factors so the user can choose one
+        if args.sweep is not None:
+            with timed_phase(timings, "Sweep"):
+                df_options = sweep_rejection_cost_factors(
+                    df, batches, sorting_method, args.sweep or REJECTION_COST_FACTORS, args.workers,
+                )
+                df_options.to_sql(
+                    "Balancing_Options_Table",
+                    conn,
+                    index=False,
+                    if_exists="replace",
+                    dtype={
+                        "Batch Number": "INTEGER",
+                        "Rejection Cost Factor": "REAL",
+                        "Accepted Cells": "INTEGER",
+                        "Mean N:P Deviation": "REAL",
+                        "Sorting Method": "INTEGER",
+                    },
+                )
+
+        # Read the stored duals from the previous run for incremental updates
+        df_state = None
+        new_states = []
+        if args.incremental:
+            try:
+                df_state = pd.read_sql("SELECT * FROM Balancing_State_Table", conn)
+            except pd.errors.DatabaseError:
+                print("No Balancing_State_Table found, solving all batches from scratch")
+
+        # Incremental batches are updated from the stored duals, the rest are solved from scratch
+        # Batches solved before with the same values take the stored solution
+        solutions = {}
+        batches_to_solve = []
+        fingerprints = {}
+        if not args.no_cache:
+            create_cache_table(conn)
+        for batch_number, row_indices in batches:
+            start_time = time.perf_counter()
+            df_batch = df.iloc[row_indices]
+            fingerprints[batch_number] = batch_fingerprint(
+                df_batch, sorting_method, rejection_cost_factor, args.budget,
             )
-            df_batch = df[batch_mask]
-            # if no cells in this batch, skip
-            if len(df_batch) == 0:
-                print(f"Skipping batch number {batch_number} as there are no available cells.")
+            if not args.no_cache and not args.incremental and (
+                cached_solution := read_cached_solution(conn, fingerprints[batch_number], len(row_indices))
+            ) is not None:
+                print(f"Using cached solution for batch {batch_number}")
+                solutions[batch_number] = cached_solution
+                status = "cached"
+            elif args.incremental and (
+                sorting_method == 3 or (sorting_method == 6 and get_ratio_classes(df_batch).max() == 0)
+            ):
+                anode_ind, cathode_ind, df_batch_state = incremental_cost_matrix_assign(
+                    df_batch, batch_number, df_state, rejection_cost_factor,
+                )
+                solutions[batch_number] = (anode_ind, cathode_ind, np.arange(len(row_indices)))
+                new_states.append(df_batch_state)
+                status = "incremental"
+            else:
+                batches_to_solve.append((batch_number, row_indices))
                 continue
-            row_indices = np.where(batch_mask)[0]
-            n_rows = len(row_indices)
-            n_rows_skipped = sum(df["Batch Number"] == batch_number) - n_rows
-            print(f"Batch number {batch_number} has {n_rows} cells.")
-            if n_rows_skipped:
-                print(f"Ignoring {n_rows_skipped} cells that do not have "
-                      f"Last Completed Step = 0 and Error Code = 0.")
-
-            # Reorder the anode and cathode rack positions based on the sorting method
-            match sorting_method:
-                case 0: # Do not sort, do not check N:P ratio
-                    anode_ind = np.arange(n_rows)
-                    cathode_ind = np.arange(n_rows)
-                    ratio_ind = np.arange(n_rows)
-
-                case 1: # Do not sort
-                    anode_ind = np.arange(n_rows)
-                    cathode_ind = np.arange(n_rows)
-                    ratio_ind = np.arange(n_rows)
-
-                case 2: # Order by capacity
-                    # I think this is always worse than the cost matrix approach
-                    anode_sort = np.argsort(df_batch["Anode Balancing Capacity (mAh)"])
-                    cathode_sort = np.argsort(df_batch["Cathode Balancing Capacity (mAh)"])
-                    # Ensure that anode positions do not change
-                    anode_ind = np.arange(n_rows)
-                    cathode_ind = cathode_sort.iloc[np.argsort(anode_sort)]
-                    ratio_ind = np.arange(n_rows)
-
-                case 3: # Use cost matrix and linear sum assignment
-                    anode_ind, cathode_ind = cost_matrix_assign(df_batch)
-                    ratio_ind = np.arange(n_rows)
-
-                case 4: # Use greedy 3D matching
-                    anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(df_batch)
-
-                case 5: # Use exact 3D matching
-                    try:
-                        anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(df_batch,exact=True)
-                    except ValueError:
-                        print("Exact matching took too long, using greedy matching instead")
-                        anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(df_batch)
-
-                case 6: # Choose automatically
-                    # If all ratios are the same, use 2d matching
-                    if (len(df_batch["Target N:P Ratio"].unique()) == 1 &
-                        len(df_batch["Minimum N:P Ratio"].unique()) == 1 &
-                        len(df_batch["Maximum N:P Ratio"].unique()) == 1):
-                        anode_ind, cathode_ind = cost_matrix_assign(df_batch)
-                        ratio_ind = np.arange(n_rows)
-                    # Otherwise, try exact matching, if timeout use greedy matching
-                    else:
-                        try:
-                            anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(df_batch,exact=True)
-                        except ValueError:
-                            print("Exact matching took too long, using greedy matching instead")
-                            anode_ind, cathode_ind, ratio_ind = cost_matrix_assign_3d(df_batch)
+            timings.append({
+                "Phase": "Solve batch",
+                "Batch Number": batch_number,
+                "Cells": len(row_indices),
+                "Status": status,
+                "Seconds": time.perf_counter() - start_time,
+            })
+
+        batch_stats = []
+        with timed_phase(timings, "Solve batches"):
+            if args.parallel:
+                # Solve all batches at the same time, each can use the time until the deadline
+                batch_solutions = solve_batches_parallel(
+                    df, batches_to_solve, sorting_method, rejection_cost_factor,
+                    TIMEOUT_SECONDS, args.budget, args.workers, batch_stats,
+                )
+                for (batch_number, _row_indices), solution in zip(batches_to_solve, batch_solutions):
+                    solutions[batch_number] = solution
+            else:
+                # All batches share one time budget, unused time is passed on to the remaining batches
+                deadline = time.perf_counter() + TIMEOUT_SECONDS
+                for batch_count, (batch_number, row_indices) in enumerate(batches_to_solve):
+                    now = time.perf_counter()
+                    # Every batch gets a minimum time, even if earlier batches used up the budget
+                    batch_timeout = max(deadline - now, 0) / (len(batches_to_solve) - batch_count)
+                    batch_deadline = now + max(batch_timeout, MIN_BATCH_TIMEOUT_SECONDS)
+                    stats = {}
+                    solutions[batch_number] = solve_batch(
+                        df.iloc[row_indices], sorting_method, rejection_cost_factor,
+                        deadline=batch_deadline, latency_budget=args.budget, stats=stats,
+                    )
+                    batch_stats.append(stats)
+        for (batch_number, row_indices), stats in zip(batches_to_solve, batch_stats):
+            timings.append({"Phase": "Solve batch", "Batch Number": batch_number, "Cells": len(row_indices), **stats})
+
+        with timed_phase(timings, "Rearrange electrodes"):
+            # Each row takes its anode, cathode and ratio from these rows, built up for all batches
+            anode_perm = np.arange(len(df))
+            cathode_perm = np.arange(len(df))
+            ratio_perm = np.arange(len(df))
+            for batch_number, row_indices in batches:
+                anode_ind, cathode_ind, ratio_ind = solutions[batch_number]
+                anode_perm[row_indices] = row_indices[anode_ind]
+                cathode_perm[row_indices] = row_indices[cathode_ind]
+                ratio_perm[row_indices] = row_indices[ratio_ind]
 
             # Rearrange the electrodes in the main dataframe
-            rearrange_electrode_columns(df, row_indices, anode_ind, cathode_ind, ratio_ind)
-
-        # Read base_sample_id from the settings table
-        df_settings = pd.read_sql("SELECT * FROM Settings_Table", conn)
-        base_sample_id = df_settings.loc[df_settings["key"] == "Base Sample ID", "value"].to_numpy()[0]
-
-        # Update the actual N:P ratio, accepted cell numbers and sample ID in the main dataframe
-        if sorting_method == 0:
-            update_cell_numbers(df, base_sample_id, check_NP_ratio=False)
-        else:
-            update_cell_numbers(df, base_sample_id)
-
-        # Write the updated table back to the database
-        df.to_sql("Cell_Assembly_Table", conn, index=False, if_exists="replace")
+            rearrange_electrode_columns(df, anode_perm, cathode_perm, ratio_perm)
+
+        with timed_phase(timings, "Write state and cache"):
+            # Cache the solution of each solved batch, and the identity for the rearranged batch so a
+            # rerun on the updated table also skips solving
+            if not args.no_cache and not args.incremental:
+                # A solution that is not proven optimal could improve with more time, so it is not cached
+                uncached_batches = {
+                    batch_number for (batch_number, _row_indices), stats in zip(batches_to_solve, batch_stats)
+                    if stats["Sorting Method"] not in UNTIMED_SORTING_METHODS and stats["Status"] != "optimal"
+                }
+                new_cache_entries = {}
+                for batch_number, row_indices in batches:
+                    if batch_number in uncached_batches:
+                        continue
+                    new_cache_entries[fingerprints[batch_number]] = solutions[batch_number]
+                    rearranged_fingerprint = batch_fingerprint(
+                        df.iloc[row_indices], sorting_method, rejection_cost_factor, args.budget,
+                    )
+                    new_cache_entries[rearranged_fingerprint] = (np.arange(len(row_indices)),) * 3
+                write_cached_solutions(conn, new_cache_entries)
+
+            if new_states:
+                df_new_state = pd.concat(new_states, ignore_index=True)
+                if df_state is not None:
+                    # Keep the stored duals of the batches that were not updated incrementally in this run
+                    df_new_state = pd.concat([
+                        df_state[~df_state["Batch Number"].isin(df_new_state["Batch Number"])],
+                        df_new_state,
+                    ], ignore_index=True)
+                df_new_state.to_sql("Balancing_State_Table", conn, index=False, if_exists="replace")
+
+        with timed_phase(timings, "Update cell numbers"):
+            # Read base_sample_id from the settings table
+            base_sample_id = read_setting(conn, "Base Sample ID")
+
+            # Update the actual N:P ratio, accepted cell numbers and sample ID in the main dataframe
+            if sorting_method == 0:
+                update_cell_numbers(df, base_sample_id, check_NP_ratio=False)
+            else:
+                update_cell_numbers(df, base_sample_id)
+
+        # Write the changed values back to the database
+        with timed_phase(timings, "Write table"):
+            update_table(conn, "Cell_Assembly_Table", df, df_original, key="Rack Position")
         print("Updated database successfully")
 
+        # Summarise where the time was spent and keep it in the database for diagnosing slow runs
+        timings.append({"Phase": "Total", "Seconds": time.perf_counter() - run_start_time})
+        df_performance = performance_log(timings, run_start, sorting_method, rejection_cost_factor)
+        print_performance_summary(df_performance)
+        df_performance.to_sql(
+            "Performance_Log", conn, index=False, if_exists="append", dtype=PERFORMANCE_LOG_DTYPES,
+        )
+
 if __name__ == "__main__":
     main()
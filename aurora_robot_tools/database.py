@@ -0,0 +1,275 @@
+"""Copyright © 2024, Empa, Graham Kimbell, Enea Svaluto-Ferro, Ruben Kuhnel, Corsin Battaglia.
+
+Shared functions for reading and writing the chemspeedDB database.
+
+The scripts read a table into a dataframe, modify it, then write it back to the database. read_table
+only selects the columns a script needs and gives every column the same dtype in every script:
+nullable integers for rack positions, cell numbers, steps and error codes, and floats for weights,
+capacities, diameters, volumes and ratios. Replacing the whole table with pandas to_sql drops and
+recreates it, which loses the declared column types and holds the write lock for longer than needed.
+Instead, update_table compares the modified dataframe with the one that was read and only updates the
+values that changed, in one short BEGIN IMMEDIATE transaction from write_transaction.
+
+AutoSuite and the scripts use the database at the same time. A connection waits up to
+BUSY_TIMEOUT_SECONDS for a lock, and write_transaction retries taking the write lock with increasing
+backoff. Set WAL_MODE to True to switch the database to write-ahead logging, so readers do not block
+the writer and the writer does not block readers. The journal mode is stored in the database file,
+so only enable it once AutoSuite has been checked with a WAL database. It is switched back with
+`PRAGMA journal_mode = DELETE`. Run stress_database.py to compare the two modes under load.
+
+Usage:
+    The scripts are run directly rather than as part of a package, so they add the repository folder
+    to the path before importing this module, e.g.
+
+    sys.path.append(str(Path(__file__).resolve().parents[2]))
+    from aurora_robot_tools.database import update_table
+"""
+
+import contextlib
+import random
+import sqlite3
+import time
+from collections.abc import Iterator
+
+import pandas as pd
+
+WAL_MODE = False
+
+BUSY_TIMEOUT_SECONDS = 5
+
+LOCK_RETRIES = 5
+
+LOCK_BACKOFF_SECONDS = 0.05
+
+INTEGER_COLUMNS = [
+    "Rack Position",
+    "Anode Rack Position",
+    "Cathode Rack Position",
+    "Cell Number",
+    "Last Completed Step",
+    "Current Press Number",
+    "Error Code",
+    "Press Number",
+    "Current Cell Number Loaded",
+    "Step Number",
+]
+
+FLOAT_COLUMN_SUFFIXES = (
+    "(mg)",
+    "(mm)",
+    "(mAh)",
+    "(mAh/g)",
+    "(mAh/cm2)",
+    "(uL)",
+    "Weight Fraction",
+    "N:P Ratio",
+    "N:P ratio overlap factor",
+)
+
+# Per-connection settings, keep temporary tables in memory and use a larger page cache
+CONNECTION_PRAGMAS = {
+    "temp_store": "MEMORY",
+    "cache_size": -32000,
+    "mmap_size": 268435456,
+}
+
+
+def connect(
+        database_filepath: str,
+        wal: bool | None = None,
+        timeout: float = BUSY_TIMEOUT_SECONDS,
+    ) -> sqlite3.Connection:
+    """Open a connection to the database with the CONNECTION_PRAGMAS applied.
+
+    The connection is used like sqlite3.connect, e.g. `with connect(DATABASE_FILEPATH) as conn:`.
+
+    Args:
+        database_filepath (str): Path to the database file.
+        wal (bool, optional): Switch the database to write-ahead logging, with synchronous = NORMAL
+            which is safe in WAL mode. Defaults to WAL_MODE.
+        timeout (float, optional): Seconds to wait for a lock before raising "database is locked".
+            Defaults to BUSY_TIMEOUT_SECONDS.
+
+    Returns:
+        sqlite3.Connection: The connection to the database.
+
+    """
+    conn = sqlite3.connect(database_filepath, timeout=timeout)
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if WAL_MODE if wal is None else wal:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def is_locked_error(error: Exception) -> bool:
+    """Check if an error is caused by another connection holding a lock."""
+    return "locked" in str(error) or "busy" in str(error)
+
+
+@contextlib.contextmanager
+def write_transaction(
+        conn: sqlite3.Connection,
+        retries: int = LOCK_RETRIES,
+        backoff_seconds: float = LOCK_BACKOFF_SECONDS,
+    ) -> Iterator[sqlite3.Connection]:
+    """Run the statements in a with block in one write transaction, committed at the end.
+
+    BEGIN IMMEDIATE takes the write lock at the start, so the transaction cannot fail part-way when
+    another connection is writing. If the lock is still held after the busy timeout, it is retried
+    with exponential backoff and jitter. The transaction is rolled back if the block raises. If the
+    connection is already in a transaction, the block runs in that transaction, and committing or
+    rolling it back is left to the caller.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        retries (int, optional): Number of times to retry taking the lock. Defaults to LOCK_RETRIES.
+        backoff_seconds (float, optional): Wait before the first retry, doubled for each retry.
+            Defaults to LOCK_BACKOFF_SECONDS.
+
+    Yields:
+        sqlite3.Connection: The connection, in a transaction.
+
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    for attempt in range(retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e) or attempt == retries:
+                raise
+            time.sleep(backoff_seconds * 2**attempt * (1 + random.random()))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def column_dtype(column: str, float_dtype: str = "float64") -> str | None:
+    """Get the pandas dtype of a chemspeedDB column, or None to let pandas choose."""
+    if column in INTEGER_COLUMNS:
+        return "Int64"
+    if column.endswith(FLOAT_COLUMN_SUFFIXES):
+        return float_dtype
+    return None
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    """Get the column names of a table."""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def read_table(
+        conn: sqlite3.Connection,
+        table: str,
+        columns: list[str] | None = None,
+        where: str | None = None,
+        params: tuple = (),
+        float_dtype: str = "float64",
+    ) -> pd.DataFrame:
+    """Read the selected columns of a table with the dtypes from column_dtype.
+
+    Columns that are not in the table are skipped, so scripts can ask for optional columns and check
+    whether they were read. The query only depends on the arguments, so sqlite3 reuses the prepared
+    statement when the same read is repeated on a connection.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        table (str): Name of the table to read.
+        columns (list[str], optional): Columns to read. Defaults to all columns.
+        where (str, optional): SQL condition to select rows, with ? placeholders for params.
+        params (tuple, optional): Values for the placeholders in where.
+        float_dtype (str, optional): dtype of the float columns. Only use "float32" to save memory
+            when the values are not written back, update_table would round them. Defaults to
+            "float64".
+
+    Returns:
+        pandas.DataFrame: The selected columns and rows of the table.
+
+    """
+    existing_columns = table_columns(conn, table)
+    if columns is None:
+        columns = existing_columns
+    else:
+        columns = [column for column in columns if column in existing_columns]
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+    query = f'SELECT {quoted_columns} FROM "{table}"'
+    if where:
+        query += f" WHERE {where}"
+    dtypes = {column: dtype for column in columns if (dtype := column_dtype(column, float_dtype))}
+    return pd.read_sql(query, conn, params=params, dtype=dtypes)
+
+
+def read_setting(conn: sqlite3.Connection, key: str) -> str:
+    """Read a value from the Settings_Table, e.g. read_setting(conn, "Base Sample ID")."""
+    return conn.execute('SELECT "value" FROM Settings_Table WHERE "key" = ?', (key,)).fetchone()[0]
+
+
+def sqlite_type(series: pd.Series) -> str:
+    """Get the SQLite column type for a pandas series."""
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(series):
+        return "REAL"
+    return "TEXT"
+
+
+def _to_sql_values(series: pd.Series) -> list:
+    """Convert a series to a list of Python values, with None for missing values."""
+    return [None if pd.isna(value) else value for value in series.to_numpy(dtype=object)]
+
+
+def update_table(
+        conn: sqlite3.Connection,
+        table: str,
+        df: pd.DataFrame,
+        df_original: pd.DataFrame,
+        key: str,
+    ) -> int:
+    """Write the values that changed in a dataframe back to a table in one transaction.
+
+    Rows are matched on the key column, which must not be changed. Columns that are not in the
+    original dataframe are added to the table. Each changed column is written with one executemany
+    UPDATE statement, so the number of rows written scales with the number of changed values.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database.
+        table (str): Name of the table to update.
+        df (pandas.DataFrame): The modified table.
+        df_original (pandas.DataFrame): The table as it was read from the database.
+        key (str): Column identifying each row, e.g. "Rack Position".
+
+    Returns:
+        int: The number of values updated.
+
+    """
+    if not df[key].reset_index(drop=True).equals(df_original[key].reset_index(drop=True)):
+        msg = f"Cannot update {table}, the rows or the {key} column have changed"
+        raise ValueError(msg)
+
+    n_updated = 0
+    with write_transaction(conn):
+        for column in df.columns:
+            new = df[column]
+            if column in df_original.columns:
+                old = df_original[column].set_axis(new.index)
+                changed = (new != old).fillna(True) & ~(new.isna() & old.isna())
+            else:
+                conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {sqlite_type(new)}')
+                changed = new.notna()
+            changed = changed.to_numpy(dtype=bool)
+            if not changed.any():
+                continue
+            conn.executemany(
+                f'UPDATE "{table}" SET "{column}" = ? WHERE "{key}" = ?',
+                zip(_to_sql_values(new[changed]), _to_sql_values(df[key][changed])),
+            )
+            n_updated += int(changed.sum())
+    print(f"Updated {n_updated} values in {table}")
+    return n_updated
@@ -12,11 +12,14 @@ Usage:
     It can also be called from the command line.
 """
 
-import sqlite3
 import sys
+from pathlib import Path
 import numpy as np
 import pandas as pd
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect, read_table, update_table
+
 DATABASE_FILEPATH = "C:\\Modules\\Database\\chemspeedDB.db"
 
 # Multiply all the volumes by safety_factor to account for evaporation and error
@@ -26,10 +29,15 @@ else:
     safety_factor = 1.1
 print(f"Multiplying all electrolyte volumes by {safety_factor}.")
 
-with sqlite3.connect(DATABASE_FILEPATH) as conn:
+with connect(DATABASE_FILEPATH) as conn:
     # Read the tables from the database
-    df = pd.read_sql("SELECT * FROM Cell_Assembly_Table", conn)
-    df_electrolyte = pd.read_sql("SELECT * FROM Electrolyte_Table", conn)
+    df = read_table(
+        conn,
+        "Cell_Assembly_Table",
+        ["Electrolyte Position", "Cell Number", "Error Code", "Electrolyte Amount (uL)"],
+    )
+    df_electrolyte = read_table(conn, "Electrolyte_Table")
+    df_electrolyte_original = df_electrolyte.copy()
 
     # number_of_electrolyte_positions is max of column "Electrolyte Position" in df_electrolyte
     n = df_electrolyte["Electrolyte Position"].max()
@@ -48,9 +56,10 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
     # will then be used to mix other electrolytes
     volumes = np.zeros(n)
     for i in range(n):
+        # Cell Number and Error Code are nullable integers, cells with a missing value are not counted
         mask = ((df["Electrolyte Position"] == i + 1)
                 & (df["Cell Number"] > 0)
-                & (df["Error Code"] == 0))
+                & (df["Error Code"] == 0)).fillna(False)
         volumes[i] = df.loc[mask, "Electrolyte Amount (uL)"].sum() * safety_factor
 
     cumulative_volumes = volumes
@@ -64,7 +73,7 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
     df_electrolyte["Cumulative Volume Required (uL)"] = cumulative_volumes
 
     # Write the electrolyte table back to the database
-    df_electrolyte.to_sql("Electrolyte_Table", conn, index=False, if_exists="replace")
+    update_table(conn, "Electrolyte_Table", df_electrolyte, df_electrolyte_original, key="Electrolyte Position")
 
     # Create a matrix with the volumes required for each source and target vial
     mixing_matrix = mix_fractions * volumes[:, np.newaxis]
@@ -83,6 +92,7 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
                 volumes_to_mix.append(mixing_matrix[i, j])
 
     # Write the mixing steps to the Mixing_Table and save it to the database
+    # The number of mixing steps changes, so the whole table is replaced
     df_mixing_table = pd.DataFrame(columns=["Source Position", "Target Position", "Volume (uL)"],
                                    data=zip(source_positions, target_positions, volumes_to_mix))
     df_mixing_table.to_sql(
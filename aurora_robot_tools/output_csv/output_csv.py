@@ -2,21 +2,20 @@
 
 Convert the finished database to a csv file that can be read by Aurora and AiiDA.
 """
-import sqlite3
 import sys
+from pathlib import Path
 from tkinter import Tk, filedialog
 
-import pandas as pd
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from aurora_robot_tools.database import connect, read_setting, read_table
 
 DATABASE_FILEPATH = "C:\\Modules\\Database\\chemspeedDB.db"
 
 DEFAULT_OUTPUT_FILEPATH = "%userprofile%\\Desktop\\Outputs"
 
 # Get Run ID from the settings table
-with sqlite3.connect(DATABASE_FILEPATH) as conn:
-    cursor = conn.cursor()
-    cursor.execute("SELECT `value` FROM Settings_Table WHERE `key` = 'Base Sample ID'")
-    run_id = cursor.fetchone()[0]
+with connect(DATABASE_FILEPATH) as conn:
+    run_id = read_setting(conn, "Base Sample ID")
 
 # Open file dialog to set the output file path
 Tk().withdraw()  # to hide the main window
@@ -71,9 +70,9 @@ column_conversion = {
     "Batch Number" : "Subbatch",
 }
 
-with sqlite3.connect(DATABASE_FILEPATH) as conn:
+with connect(DATABASE_FILEPATH) as conn:
     # Get cell assembly table for finished cells
-    df = pd.read_sql("SELECT * FROM Cell_Assembly_Table WHERE `Last Completed Step` >= 10 AND `Error Code` = 0", conn)
+    df = read_table(conn, "Cell_Assembly_Table", where='"Last Completed Step" >= 10 AND "Error Code" = 0')
     # If df is empty (no finished cells), exit
     if df.empty:
         print("No finished cells found in database.")
@@ -103,7 +102,7 @@ with sqlite3.connect(DATABASE_FILEPATH) as conn:
     ]
     df = df.drop(columns=columns_to_drop)
     # Get timestamp table, pivot so step numbers are columns, merge with cell assembly table
-    df_timestamp = pd.read_sql("SELECT * FROM Timestamp_Table", conn)
+    df_timestamp = read_table(conn, "Timestamp_Table")
     # Remove rows with the same cell number and step number, keep the latest timestamp
     df_timestamp = df_timestamp.sort_values("Timestamp", ascending=False).drop_duplicates(["Cell Number", "Step Number"])
     df_timestamp = df_timestamp.pivot_table(index="Cell Number", columns="Step Number", values="Timestamp")
@@ -0,0 +1,168 @@
+"""Copyright © 2024, Empa, Graham Kimbell, Enea Svaluto-Ferro, Ruben Kuhnel, Corsin Battaglia.
+
+Stress test the shared database functions with many concurrent readers and writers.
+
+A temporary database with a Cell_Assembly_Table of ROWS rows is created. Writer processes repeatedly
+increment the Cell Number of every row in one write_transaction, and reader processes repeatedly
+read the table with read_table. Every read must see the same Cell Number in all rows, otherwise a
+reader saw a partly written transaction, and at the end every row must equal the number of committed
+writes. The number of operations, lock errors and the slowest operation of each kind are printed.
+Opening a connection counts as part of the first operation, as it can also wait for a lock.
+
+Usage:
+    py stress_database.py [--readers N] [--writers N] [--seconds S] [--timeout S] [--mode MODE]
+
+    - `--readers N`, `--writers N`: number of reader and writer processes, default 8 and 4.
+    - `--seconds S`: how long to run each mode, default 10.
+    - `--timeout S`: busy timeout of each connection, default BUSY_TIMEOUT_SECONDS.
+    - `--mode MODE`: "rollback", "wal" or "both" (default), to compare the journal modes.
+
+    Exits with code 1 if any read was inconsistent or the final count is wrong.
+"""
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from aurora_robot_tools.database import (
+    BUSY_TIMEOUT_SECONDS,
+    connect,
+    is_locked_error,
+    read_table,
+    write_transaction,
+)
+
+ROWS = 36
+
+
+def create_database(database_filepath: str, wal: bool) -> None:
+    """Create a Cell_Assembly_Table with ROWS rows and all cell numbers 0."""
+    with connect(database_filepath, wal=wal) as conn:
+        pd.DataFrame({
+            "Rack Position": range(1, ROWS + 1),
+            "Cell Number": 0,
+            "Anode Weight (mg)": 0.0,
+        }).to_sql("Cell_Assembly_Table", conn, index=False, dtype={"Rack Position": "INTEGER PRIMARY KEY"})
+    conn.close()
+
+
+def writer(database_filepath: str, wal: bool, timeout: float, wall_deadline: float) -> dict:
+    """Increment every Cell Number in one transaction until the deadline, count the commits."""
+    result = {"role": "writer", "operations": 0, "locked": 0, "inconsistent": 0, "max_seconds": 0.0}
+    conn = None
+    while time.time() < wall_deadline:
+        start_time = time.perf_counter()
+        try:
+            conn = conn or connect(database_filepath, wal=wal, timeout=timeout)
+            with write_transaction(conn):
+                cell_number = conn.execute('SELECT MAX("Cell Number") FROM Cell_Assembly_Table').fetchone()[0]
+                conn.executemany(
+                    'UPDATE Cell_Assembly_Table SET "Cell Number" = ?, "Anode Weight (mg)" = ? '
+                    'WHERE "Rack Position" = ?',
+                    [(cell_number + 1, time.time(), rack_position) for rack_position in range(1, ROWS + 1)],
+                )
+            result["operations"] += 1
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e):
+                raise
+            result["locked"] += 1
+        result["max_seconds"] = max(result["max_seconds"], time.perf_counter() - start_time)
+    if conn is not None:
+        conn.close()
+    return result
+
+
+def reader(database_filepath: str, wal: bool, timeout: float, wall_deadline: float) -> dict:
+    """Read the table until the deadline, count reads which see a partly written transaction."""
+    result = {"role": "reader", "operations": 0, "locked": 0, "inconsistent": 0, "max_seconds": 0.0}
+    conn = None
+    while time.time() < wall_deadline:
+        start_time = time.perf_counter()
+        try:
+            conn = conn or connect(database_filepath, wal=wal, timeout=timeout)
+            df = read_table(conn, "Cell_Assembly_Table", ["Rack Position", "Cell Number"])
+            result["operations"] += 1
+            if df["Cell Number"].nunique() != 1:
+                result["inconsistent"] += 1
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            if not is_locked_error(e):
+                raise
+            result["locked"] += 1
+        result["max_seconds"] = max(result["max_seconds"], time.perf_counter() - start_time)
+    if conn is not None:
+        conn.close()
+    return result
+
+
+def run_stress_test(readers: int, writers: int, seconds: float, wal: bool, timeout: float) -> bool:
+    """Run the readers and writers against a new temporary database and print the results.
+
+    Args:
+        readers (int): Number of reader processes.
+        writers (int): Number of writer processes.
+        seconds (float): How long to run for.
+        wal (bool): Use write-ahead logging instead of the rollback journal.
+        timeout (float): Busy timeout of each connection in seconds.
+
+    Returns:
+        bool: True if every read was consistent and no committed write was lost.
+
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        database_filepath = str(Path(tempdir) / "stress.db")
+        create_database(database_filepath, wal)
+        # Allow a second for the processes to start
+        with ProcessPoolExecutor(max_workers=readers + writers) as executor:
+            wall_deadline = time.time() + seconds + 1
+            futures = [
+                executor.submit(writer, database_filepath, wal, timeout, wall_deadline) for _ in range(writers)
+            ] + [
+                executor.submit(reader, database_filepath, wal, timeout, wall_deadline) for _ in range(readers)
+            ]
+            results = [future.result() for future in futures]
+        with connect(database_filepath) as conn:
+            final_cell_numbers = read_table(conn, "Cell_Assembly_Table")["Cell Number"]
+        conn.close()
+
+    df_results = pd.DataFrame(results).groupby("role").agg(
+        processes=("operations", "size"),
+        operations=("operations", "sum"),
+        locked=("locked", "sum"),
+        inconsistent=("inconsistent", "sum"),
+        max_seconds=("max_seconds", "max"),
+    )
+    commits = int(df_results.loc["writer", "operations"]) if writers else 0
+    lost_writes = not (final_cell_numbers == commits).all()
+    print(f"{'WAL' if wal else 'Rollback journal'} mode, {seconds} seconds, busy timeout {timeout} seconds")
+    print(df_results.to_string())
+    print(f"Final cell numbers {final_cell_numbers.min()}-{final_cell_numbers.max()}, {commits} commits\n")
+    return not lost_writes and df_results["inconsistent"].sum() == 0
+
+
+def main() -> None:
+    """Run the stress test for the chosen journal modes."""
+    parser = argparse.ArgumentParser(description="Stress test concurrent access to a temporary database.")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=BUSY_TIMEOUT_SECONDS)
+    parser.add_argument("--mode", choices=["rollback", "wal", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = {"rollback": [False], "wal": [True], "both": [False, True]}[args.mode]
+    passed = [run_stress_test(args.readers, args.writers, args.seconds, wal, args.timeout) for wal in modes]
+    if not all(passed):
+        print("FAILED: inconsistent reads or lost writes")
+        sys.exit(1)
+    print("All reads were consistent and no writes were lost")
+
+
+if __name__ == "__main__":
+    main()